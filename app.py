@@ -1,11 +1,12 @@
 import streamlit as st
 import pandas as pd
-import gspread
-from google.oauth2.service_account import Credentials
 from datetime import date, datetime, timedelta
-import calendar
-import re
-import io
+import json
+import time
+from functools import partial
+
+# 画面1回分の描画時間の計測用（7. で記録）
+_run_started = time.perf_counter()
 
 # --- 0. UIデザインの精密調整 (CSS) ---
 # テキスト入力、セレクトボックス、ボタンの垂直位置を完全に一致させます
@@ -48,105 +49,23 @@ st.markdown("""
     </style>
     """, unsafe_allow_html=True)
 
-# --- 1. 接続・認証設定 ---
-@st.cache_resource
-def get_gspread_client():
-    info = dict(st.secrets["gcp_service_account"])
-    scopes = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
-    creds = Credentials.from_service_account_info(info, scopes=scopes)
-    return gspread.authorize(creds)
-
-client = get_gspread_client()
-spreadsheet_id = "10SPAlhEavpSZzHr2iCgu3U_gaaW6IHWgvjNTdvSWY9A"
-sheet = client.open_by_key(spreadsheet_id)
-
-# --- 2. データ操作基本関数 ---
-def load_data(sheet_name):
-    try:
-        worksheet = sheet.worksheet(sheet_name)
-        data = worksheet.get_all_values()
-        if len(data) > 0:
-            cols = [c.strip() for c in data[0]]
-            return pd.DataFrame(data[1:], columns=cols)
-        return pd.DataFrame()
-    except:
-        return pd.DataFrame()
-
-def save_data(df, sheet_name):
-    try:
-        try:
-            worksheet = sheet.worksheet(sheet_name)
-        except:
-            worksheet = sheet.add_worksheet(title=sheet_name, rows="2000", cols="20")
-        worksheet.clear()
-        df_save = df.fillna("")
-        worksheet.update([df_save.columns.values.tolist()] + df_save.values.tolist())
-        return True
-    except Exception as e:
-        st.error(f"保存エラー: {e}")
-        return False
-
-def validate_input(s, fmt):
-    try:
-        if fmt == "年月日":
-            if not re.match(r"^\d{8}$", s): return False, "8桁の数字で入力してください"
-            dt = datetime.strptime(s, "%Y%m%d").date()
-        else:
-            if not re.match(r"^\d{6}$", s): return False, "6桁の数字で入力してください"
-            y, m = int(s[:4]), int(s[4:])
-            if not (1 <= m <= 12): return False, "月が不正です"
-            dt = date(y, m, calendar.monthrange(y, m)[1])
-        if dt < date.today(): return False, "過去の日付は登録できません"
-        return True, dt
-    except:
-        return False, "正しい日付を入力してください"
-
-def convert_df(df):
-    return df.to_csv(index=False).encode('utf_8_sig')
-
-# --- ★追加：DB用スプレッドシートから同期する関数 ---
-def sync_from_database_sheet():
-    """
-    DB用スプレッドシートが別にある場合に、
-    DB側の指定ワークシートをこの運用スプレッドシートへ上書き同期します。
-
-    secrets.toml に以下を入れると有効化：
-      db_spreadsheet_id = "（DB用スプレッドシートID）"
-
-    未設定の場合は「同期スキップ（再読込のみ）」になります。
-    """
-    try:
-        db_id = st.secrets.get("db_spreadsheet_id", "")
-        if not db_id:
-            return False, "db_spreadsheet_id が未設定のため同期はスキップしました（再読込のみ）。"
-
-        db_sheet = client.open_by_key(db_id)
-
-        # 同期対象（必要に応じて増減OK）
-        targets = ["user_master", "branch_master", "shop_master", "item_master"]
-
-        for ws_name in targets:
-            try:
-                db_ws = db_sheet.worksheet(ws_name)
-                values = db_ws.get_all_values()
-                if not values:
-                    save_data(pd.DataFrame(), ws_name)
-                    continue
-
-                cols = [c.strip() for c in values[0]]
-                df_db = pd.DataFrame(values[1:], columns=cols)
-                save_data(df_db, ws_name)
-
-            except Exception as e:
-                # 1シート失敗しても他を続行
-                st.warning(f"同期スキップ: {ws_name}（{e}）")
-
-        return True, "DBシートからマスタを同期しました。"
-
-    except Exception as e:
-        return False, f"DB同期エラー: {e}"
+# --- 1〜2. 接続・データ操作（kigen_data.py） ---
+from kigen_data import (
+    append_data, archive_years, as_text, build_xlsx_report, concat_typed, convert_df, cred_index,
+    delete_data, expiry_analytics, expiry_records_for, ExpiryAnalytics, INPUT_TYPES, item_catalog,
+    ITEM_CATEGORIES, load_archive, load_data, modify_data, perf_metrics, read_upload, record_index,
+    renumber_duplicate_items, REPORT_MAX_SHEETS, retention_job, sheet_cache, sheets_using_id,
+    sync_from_database_sheet, sync_worker, update_data, validate_dates, with_new_items, write_queue,
+)
 
 # --- 3. セッション管理 ---
+_perf_before = perf_metrics.totals()
+
+def record_render(menu):
+    """この回の描画時間を perf_metrics とセッションの perf_log（直近50回）に残す"""
+    entry = perf_metrics.record_render(menu, _run_started, _perf_before)
+    st.session_state["perf_log"] = (st.session_state.get("perf_log", []) + [entry])[-50:]
+
 if 'logged_in' not in st.session_state:
     st.session_state.update({'logged_in': False, 'role': None, 'user_info': None})
 
@@ -157,16 +76,13 @@ if not st.session_state['logged_in']:
         u_id = st.text_input("ID (数字4桁)", max_chars=4)
         u_pw = st.text_input("パスワード", type="password")
         if st.form_submit_button("ログイン", use_container_width=True):
-            users = load_data("user_master")
-            if not users.empty:
-                users['id'] = users['id'].astype(str).str.strip()
-                users['password'] = users['password'].astype(str).str.strip()
-                user_row = users[(users['id'] == str(u_id).strip()) & (users['password'] == str(u_pw).strip())]
-                if not user_row.empty:
-                    st.session_state.update({'logged_in': True, 'role': user_row.iloc[0]['role'], 'user_info': user_row.iloc[0].to_dict()})
-                    st.rerun()
-                else:
-                    st.error("IDまたはパスワードが不正です")
+            user_info = cred_index.authenticate(u_id, u_pw)
+            if user_info:
+                st.session_state.update({'logged_in': True, 'role': user_info['role'], 'user_info': user_info})
+                st.rerun()
+            else:
+                st.error("IDまたはパスワードが不正です")
+    record_render("ログイン")
     st.stop()
 
 # --- 5. メインメニュー ---
@@ -176,9 +92,9 @@ st.sidebar.title(f"【{role}】")
 st.sidebar.write(f"👤 {info['name']} 様")
 
 if role == "マスター":
-    menu = st.sidebar.radio("メニュー", ["期限確認", "支部登録", "アイテム管理"])
+    menu = st.sidebar.radio("メニュー", ["期限確認", "エクセル発行", "支部登録", "アイテム管理"])
 elif role == "支部":
-    menu = st.sidebar.radio("メニュー", ["期限確認", "店舗管理", "管轄者管理", "アイテム管理", "パスワード変更"])
+    menu = st.sidebar.radio("メニュー", ["期限確認", "エクセル発行", "店舗管理", "管轄者管理", "アイテム管理", "パスワード変更"])
 elif role == "管轄者":
     menu = st.sidebar.radio("メニュー", ["期限確認", "パスワード変更"])
 elif role == "店舗":
@@ -193,15 +109,49 @@ with st.sidebar.container():
     st.markdown('<div class="sidebar-footer">', unsafe_allow_html=True)
 
     if st.button("更新", use_container_width=True):
-        ok, msg = sync_from_database_sheet()
-        if ok:
-            st.success(msg)
+        # 読み込みキャッシュだけ破棄する（接続の st.cache_resource は残す。消すとAPIErrorを誘発しやすい）
+        sheet_cache.invalidate()
+        if sync_worker:
+            # 同期と先読みはバックグラウンドで行い、この画面では待たない
+            sync_worker.trigger()
         else:
-            st.info(msg)
-
-        # キャッシュクリアはしない（これが原因でAPIErrorを誘発しやすい）
+            t = time.perf_counter()
+            ok, msg, report = sync_from_database_sheet()
+            retention_job.run_if_due()  # 同期ワーカーがないときは、ここでアーカイブも1日1回行う
+            st.session_state["sync_result"] = {
+                "state": "完了" if ok else "スキップ/エラー", "at": datetime.now(),
+                "ms": round((time.perf_counter() - t) * 1000), "msg": msg, "report": report,
+            }
         st.rerun()
 
+    sync_status = sync_worker.status() if sync_worker else st.session_state.get("sync_result")
+    if sync_status:
+        at = f"{sync_status['at']:%H:%M:%S} " if sync_status["at"] else ""
+        ms = f"（{sync_status['ms']}ms）" if sync_status["ms"] is not None else ""
+        with st.expander(f"マスタ同期: {at}{sync_status['state']}{ms}"):
+            st.caption(sync_status["msg"])
+            if sync_status["report"]:
+                st.dataframe(pd.DataFrame(sync_status["report"]).T, use_container_width=True)
+
+    c_stats = sheet_cache.stats()
+    st.caption(f"キャッシュ ヒット {c_stats['hits']} / ミス {c_stats['misses']}")
+
+    # secrets.toml の [debug] panel = true で表示
+    if dict(st.secrets.get("debug", {})).get("panel"):
+        with st.expander("🛠️ 計測"):
+            perf_log = st.session_state.get("perf_log", [])
+            if perf_log:
+                st.caption("描画時間（このセッションの直近）")
+                st.dataframe(pd.DataFrame(perf_log).drop(columns="totals").tail(20), hide_index=True, use_container_width=True)
+            st.caption(f"ストレージ（API呼び出し 計 {perf_metrics.totals()['api']} 回）")
+            st.dataframe(perf_metrics.storage_frame(), hide_index=True, use_container_width=True)
+            st.caption(f"書き込みキュー {write_queue.stats}")
+            report = dict(perf_metrics.snapshot(), session=perf_log, write_queue=write_queue.stats, cache=c_stats)
+            st.download_button(
+                "JSONで保存", data=json.dumps(report, ensure_ascii=False, default=str, indent=1),
+                file_name=f"perf_{datetime.now():%Y%m%d_%H%M%S}.json", mime="application/json",
+            )
+
     st.markdown("</div>", unsafe_allow_html=True)
 
 
@@ -223,11 +173,14 @@ if menu == "店舗管理":
             new_snm = sc2.text_input("店舗名")
             new_spw = sc3.text_input("パスワード")
             if st.form_submit_button("登録"):
-                nu = pd.DataFrame([{"id": new_sid, "password": new_spw, "role":"店舗", "target_id": new_snm, "name": new_snm}])
-                ns = pd.DataFrame([{"shop_id": new_sid, "branch_id": info["id"], "shop_name": new_snm}])
-                save_data(pd.concat([u_all, nu]), "user_master")
-                save_data(pd.concat([s_all, ns]), "shop_master")
-                st.success("登録完了"); st.rerun()
+                used = sheets_using_id(new_sid, ["user_master", "shop_master"])
+                if used:
+                    st.error(f"ID「{new_sid}」はすでに使われています（{'、'.join(used)}）")
+                else:
+                    nu = pd.DataFrame([{"id": new_sid, "password": new_spw, "role":"店舗", "target_id": new_snm, "name": new_snm}])
+                    ns = pd.DataFrame([{"shop_id": new_sid, "branch_id": info["id"], "shop_name": new_snm}])
+                    if append_data(nu, "user_master") and append_data(ns, "shop_master"):
+                        st.success("登録完了"); st.rerun()
 
     st.subheader("📋 店舗一覧・一括編集")
     if not my_s_list.empty:
@@ -266,103 +219,247 @@ if menu == "店舗管理":
 
                 if c[5].button("🆙", key=f"s_up_{idx}", help="更新"):
                     new_b_id = b_all[b_all["branch_name"] == e_bnm].iloc[0]["branch_id"]
-                    # 元コードの意図を崩さず、行更新はそのまま
-                    s_all.at[idx, ["shop_id", "shop_name", "branch_id"]] = [e_sid, e_snm, new_b_id]
-                    u_all.loc[u_all["id"] == row["shop_id"], ["id", "password", "target_id", "name"]] = [e_sid, e_pw, e_snm, e_snm]
-                    save_data(s_all, "shop_master"); save_data(u_all, "user_master")
-                    st.success("更新しました"); st.rerun()
+                    # 元コードの意図を崩さず、行更新はそのまま（キーは更新前の店舗ID）
+                    # 失敗したとき（キーの重複など）はエラーを見せるため再描画しない
+                    used = sheets_using_id(e_sid, ["shop_master", "user_master"]) if e_sid != row["shop_id"] else []
+                    if used:
+                        st.error(f"ID「{e_sid}」はすでに使われています（{'、'.join(used)}）")
+                    elif update_data("shop_master", {row["shop_id"]: {"shop_id": e_sid, "shop_name": e_snm, "branch_id": new_b_id}}):
+                        if u_row.empty or update_data("user_master", {row["shop_id"]: {"id": e_sid, "password": e_pw, "target_id": e_snm, "name": e_snm}}):
+                            st.success("更新しました"); st.rerun()
+                        st.error("店舗マスタは更新しましたが、ログイン情報（user_master）は更新できませんでした")
 
                 if c[6].button("🗑️", key=f"s_de_{idx}", help="削除"):
-                    save_data(s_all.drop(idx), "shop_master")
-                    save_data(u_all[u_all["id"] != row["shop_id"]], "user_master")
-                    st.warning("削除しました"); st.rerun()
+                    if delete_data("shop_master", [row["shop_id"]]):
+                        if u_row.empty or delete_data("user_master", [row["shop_id"]]):
+                            st.warning("削除しました"); st.rerun()
+                        st.error("店舗マスタからは削除しましたが、ログイン情報（user_master）は削除できませんでした")
 
 # --- 【期限確認・一括入力・エクセル・その他共通ロジック】 ---
 elif "期限確認" in menu or "期限一覧" in menu:
     st.header(f"🔍 {menu}")
-    df = load_data("expiry_records")
-    if role == "店舗":
-        df = df[df["shop_id"] == info["name"]]
-    elif role == "管轄者":
-        my_shops = info["target_id"].split(",")
-        df = df[df["shop_id"].isin(my_shops)]
-    elif role == "支部":
-        s_master = load_data("shop_master")
-        my_s_names = s_master[s_master["branch_id"] == info["id"]]["shop_name"].tolist()
-        df = df[df["shop_id"].isin(my_s_names)]
+    df = record_index.for_role(role, info)
+
+    if role in ["支部", "マスター"] and not df.empty:
+        st.subheader("⏰ 期限アラート")
+        scope = None if role == "マスター" else record_index.branch_shops(info["id"])
+        totals = expiry_analytics.summary("category", scope).sum()
+        m = st.columns(len(ExpiryAnalytics.BUCKETS))
+        for col, (label, _, _) in zip(m, ExpiryAnalytics.BUCKETS):
+            col.metric(label, int(totals.get(label, 0)))
+        views = {"店舗別": "shop_id", "カテゴリ別": "category"}
+        if role == "マスター":
+            views["支部別"] = "branch_id"
+        for tab, (name, by) in zip(st.tabs(list(views)), views.items()):
+            summary = expiry_analytics.summary(by, scope)
+            if by == "branch_id":
+                b_all = load_data("branch_master")
+                if not b_all.empty:
+                    summary = summary.rename(index=b_all.set_index("branch_id")["branch_name"].to_dict())
+            tab.dataframe(summary, use_container_width=True)
 
     if not df.empty:
         st.subheader("📋 登録済みデータ")
-        for idx, row in df.iterrows():
-            with st.container():
-                c = st.columns([1, 2, 2, 0.5, 0.5])
-                c[0].write(row["shop_id"])
-                new_inm = c[1].text_input("商品名", value=row["item_name"], key=f"rec_nm_{idx}", label_visibility="collapsed")
-                new_exp = c[2].text_input("期限", value=row["expiry_date"], key=f"rec_dt_{idx}", label_visibility="collapsed")
-                if c[3].button("🆙", key=f"rec_upd_{idx}"):
-                    all_df = load_data("expiry_records")
-                    all_df.loc[all_df["id"] == row["id"], ["item_name", "expiry_date"]] = [new_inm, new_exp]
-                    save_data(all_df, "expiry_records"); st.success("更新完了"); st.rerun()
-                if c[4].button("🗑️", key=f"rec_del_{idx}"):
-                    all_df = load_data("expiry_records")
-                    save_data(all_df[all_df["id"] != row["id"]], "expiry_records"); st.warning("削除完了"); st.rerun()
+        # 絞り込み・並び替えはここで済ませ、描画するのは1ページ分だけにする
+        f = st.columns([2, 2, 1.2, 1.2])
+        shops = sorted(df["shop_id"].unique().tolist())
+        sel_shops = f[0].multiselect("店舗", shops) if len(shops) > 1 else []
+        sel_cats = f[1].multiselect("カテゴリ", sorted(df["category"].unique().tolist()))
+        d_from = f[2].date_input("期限（から）", value=None)
+        d_to = f[3].date_input("期限（まで）", value=None)
+        p = st.columns([2, 1, 1])
+        sort_desc = p[0].radio("並び順", ["期限が近い順", "期限が遠い順"], horizontal=True) == "期限が遠い順"
+        page_size = p[1].selectbox("表示件数", [50, 100, 200])
+
+        mask = pd.Series(True, index=df.index)
+        if sel_shops:
+            mask &= df["shop_id"].isin(sel_shops)
+        if sel_cats:
+            mask &= df["category"].isin(sel_cats)
+        if d_from:
+            mask &= df["expiry_date"] >= pd.Timestamp(d_from)
+        if d_to:
+            mask &= df["expiry_date"] <= pd.Timestamp(d_to)
+        view = df[mask].sort_values("expiry_date", ascending=not sort_desc, kind="stable")
+
+        total = len(view)
+        pages = max(1, -(-total // page_size))
+        page = p[2].number_input("ページ", min_value=1, max_value=pages, value=1, step=1)
+        start = (page - 1) * page_size
+        page_df = view.iloc[start:start + page_size]
+        st.caption(f"全 {total} 件中 {min(start + 1, total)}〜{start + len(page_df)} 件を表示（{page}/{pages} ページ）")
+
+        # 編集は表の上でまとめて行い、「変更を保存」で差分だけを1回で書き込む
+        edit_cols = ["item_name", "expiry_date"]
+        editor_key = "rec_editor_" + "_".join(map(str, [page, page_size, sort_desc, d_from, d_to] + sel_shops + sel_cats))
+        edited = st.data_editor(
+            page_df[["shop_id", "category"] + edit_cols].assign(削除=False),
+            hide_index=True, use_container_width=True, num_rows="fixed",
+            disabled=["shop_id", "category"],
+            column_config={
+                "shop_id": "店舗", "category": "カテゴリ", "item_name": "商品名",
+                "expiry_date": st.column_config.DateColumn("期限", format="YYYY-MM-DD"),
+                "削除": st.column_config.CheckboxColumn("削除"),
+            },
+            key=editor_key,
+        )
+        if st.button("変更を保存", type="primary"):
+            after = as_text(edited[edit_cols])
+            changed = after != as_text(page_df[edit_cols])
+            to_delete = page_df.loc[edited["削除"], "id"].tolist()
+            rows = page_df.index[changed.any(axis=1) & ~edited["削除"]]
+            changes = {page_df.at[i, "id"]: {c: after.at[i, c] for c in edit_cols if changed.at[i, c]} for i in rows}
+            if not changes and not to_delete:
+                st.info("変更はありません")
+            else:
+                n_upd = update_data("expiry_records", changes) if changes else 0
+                n_del = delete_data("expiry_records", to_delete) if to_delete else 0
+                # 行がずれるので編集中の状態は捨てる
+                del st.session_state[editor_key]
+                st.success(f"更新 {n_upd} 件 / 削除 {n_del} 件"); st.rerun()
+
+    # 期限から日数がたってアーカイブへ移した記録は、年を選んで読み取り専用で表示
+    years = archive_years()
+    if years or (role == "マスター" and retention_job.days > 0):
+        with st.expander("🗄️ アーカイブ（過去の記録）"):
+            if years:
+                year = st.selectbox("期限の年", years)
+                a_df = load_archive(record_index.shops_for(role, info), [year])
+                st.caption(f"{len(a_df)} 件" + ("（先頭1000件を表示）" if len(a_df) > 1000 else ""))
+                if not a_df.empty:
+                    st.dataframe(a_df.head(1000), use_container_width=True, column_config={
+                        c: st.column_config.DateColumn(format="YYYY-MM-DD") for c in ("expiry_date", "input_date")
+                    })
+            if role == "マスター" and retention_job.days > 0:
+                when = "1日1回" if sync_worker else "「更新」を押したときに1日1回"
+                st.caption(retention_job.status()["msg"] or f"期限から{retention_job.days}日以上たった記録は{when}アーカイブへ移します")
+                if st.button("今すぐアーカイブ", disabled=retention_job.running()):
+                    moved = retention_job.run()
+                    if moved is None:
+                        st.info("アーカイブは実行中です。終わってから状況を確認してください")
+                    else:
+                        st.success(f"{sum(moved.values())} 件をアーカイブへ移しました"); st.rerun()
 
 elif menu == "エクセル発行":
     st.header("📊 エクセルレポート発行")
-    df = load_data("expiry_records")
-    df = df[df["shop_id"] == info["name"]]
+    df = record_index.for_role(role, info)
     today = date.today()
     start_date = (today.replace(day=1) + timedelta(days=32)).replace(day=1)
     end_date = (start_date + timedelta(days=32)).replace(day=7)
-    df['exp_dt'] = pd.to_datetime(df['expiry_date'], errors='coerce').dt.date
-    f_df = df[(df['exp_dt'] >= start_date) & (df['exp_dt'] <= end_date)]
+    c = st.columns(2)
+    period = c[0].radio("対象期間", ["翌月分", "全期間"], horizontal=True)
+    # 店舗はカテゴリ別、支部・マスターは店舗別のシートが既定
+    split = c[1].radio("シートの分け方", ["店舗別", "カテゴリ別"], index=1 if role == "店舗" else 0, horizontal=True)
+    with_archive = period == "全期間" and bool(archive_years()) and c[0].checkbox("アーカイブを含める")
+    if period == "翌月分":
+        f_df = df[df["expiry_date"].between(pd.Timestamp(start_date), pd.Timestamp(end_date))]
+    else:
+        f_df = df
+        if with_archive:
+            archived = load_archive(record_index.shops_for(role, info))
+            if not archived.empty:
+                f_df = concat_typed([d for d in (df, archived) if not d.empty], "expiry_records").reset_index(drop=True)
     if not f_df.empty:
-        st.download_button("📥 Excel(CSV)を発行", data=convert_df(f_df), file_name=f"report_{info['id']}.csv")
-        st.dataframe(f_df.drop(columns=['exp_dt']), use_container_width=True)
+        group_by = "shop_id" if split == "店舗別" else "category"
+        if f_df[group_by].nunique() > REPORT_MAX_SHEETS:
+            st.warning(f"シート数が{REPORT_MAX_SHEETS}を超えるため、カテゴリ別で作成します")
+            group_by = "category"
+        # 作成したレポートは条件かデータが変わるまで使い回す（件数の変わらない編集も version で検知）
+        report_key = (period, group_by, with_archive, sheet_cache.version("expiry_records"), len(f_df))
+        if st.button("📊 Excelレポートを作成", type="primary"):
+            st.session_state["xlsx_report"] = {"key": report_key, "data": build_xlsx_report(f_df, group_by)}
+        report = st.session_state.get("xlsx_report")
+        if report and report["key"] == report_key:
+            st.download_button(
+                "📥 Excel(XLSX)をダウンロード", data=report["data"],
+                file_name=f"report_{info['id']}_{today:%Y%m%d}.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            )
+        # CSVは押されたときに作る（全期間のマスターは10万行になるので毎回は作らない）
+        st.download_button("📥 Excel(CSV)を発行", data=partial(convert_df, f_df), file_name=f"report_{info['id']}.csv", mime="text/csv")
+        st.caption(f"{len(f_df)} 件" + ("（先頭1000件を表示）" if len(f_df) > 1000 else ""))
+        st.dataframe(f_df.head(1000), use_container_width=True, column_config={
+            c: st.column_config.DateColumn(format="YYYY-MM-DD") for c in ("expiry_date", "input_date")
+        })
 
 elif menu == "期限入力":
     st.header(f"📦 {info['name']} - 期限入力")
-    items = load_data("item_master")
+    items = item_catalog.items()
     if not items.empty:
-        final_data = {}
-        for cat in items["category"].unique():
+        # 棚卸しなど件数が多いときは、ファイルから検証 → 1回の書き込みで登録する
+        with st.expander("📤 ファイルから一括登録（CSV / XLSX）"):
+            if "upload_done" in st.session_state:
+                st.success(st.session_state.pop("upload_done"))
+            st.caption("列：商品名（または 商品ID）・期限。期限は商品の形式に合わせて 20251231 / 202512 のように入力します")
+            up = st.file_uploader("ファイル", type=["csv", "xlsx"], key=f"exp_upload_{st.session_state.get('upload_n', 0)}")
+            if up is not None:
+                try:
+                    src = read_upload(up)
+                except Exception as e:
+                    st.error(f"読み込みエラー: {e}")
+                    src = pd.DataFrame()
+                src = src.assign(**{c: src[c] if c in src else "" for c in ("item_id", "item_name", "expiry_date")})
+                src = src[src[["item_id", "item_name", "expiry_date"]].ne("").any(axis=1)]
+                # 商品IDがあればIDで、なければ商品名で引く（同じ名前の商品が複数あるときは名前では引かない）
+                names = items.drop_duplicates("item_name", keep=False).set_index("item_name")["item_id"]
+                item_ids = src["item_id"].str.strip()
+                item_ids = item_ids.where(item_ids.ne(""), src["item_name"].str.strip().map(names))
+                matched = items.drop_duplicates("item_id").set_index("item_id").reindex(item_ids)
+                matched.index = src.index
+                dates, errors = validate_dates(src["expiry_date"], matched["input_type"].astype(str))
+                errors = errors.mask(matched["item_name"].isna(), "商品が見つかりません（同名の商品は商品IDで指定）")
+                ok = errors.eq("")
+                st.caption(f"登録できる行 {ok.sum()} 件 / エラー {(~ok).sum()} 件")
+                if (~ok).any():
+                    label = src["item_name"].where(src["item_name"].ne(""), src["item_id"])
+                    st.dataframe(pd.DataFrame({
+                        "行": src.index[~ok] + 2, "商品": label[~ok], "期限": src.loc[~ok, "expiry_date"], "エラー": errors[~ok],
+                    }), hide_index=True, use_container_width=True)
+                if ok.any() and st.button(f"{ok.sum()} 件を登録（エラーの行は除く）", type="primary"):
+                    rows = matched.loc[ok, ["category", "item_name"]].assign(expiry_date=dates[ok])
+                    if append_data(expiry_records_for(info['name'], rows), "expiry_records"):
+                        st.session_state["upload_done"] = f"{len(rows)} 件を登録しました"
+                        st.session_state["upload_n"] = st.session_state.get("upload_n", 0) + 1
+                        st.rerun()
+
+        # 入力するとそのカテゴリだけが再実行される（画面全体・シートの読み込みは走らない）
+        @st.fragment
+        def category_inputs(cat, cat_items):
             st.markdown(f"### 📍 {cat}")
-            for _, row in items[items["category"] == cat].iterrows():
-                with st.container(border=True):
-                    st.write(f"**{row['item_name']}**")
-                    ph = "20251231" if row['input_type']=="年月日" else "202512"
-                    val_str = st.text_input(f"期限", key=f"inp_{row['item_id']}", placeholder=ph)
-                    if val_str:
-                        v, r = validate_input(val_str, row['input_type'])
-                        if v: final_data[row['item_id']] = {"cat": row['category'], "name": row['item_name'], "date": r}
-                        else: st.error(r)
+            values = pd.Series([st.session_state.get(f"inp_{it['item_id']}", "") for it in cat_items], dtype=str)
+            _, errors = validate_dates(values, pd.Series([it["input_type"] for it in cat_items]))
+            with st.container(border=True):
+                for i, it in enumerate(cat_items):
+                    c = st.columns([2, 1])
+                    c[0].write(f"**{it['item_name']}**")
+                    ph = "20251231" if it['input_type'] == "年月日" else "202512"
+                    c[1].text_input("期限", key=f"inp_{it['item_id']}", placeholder=ph, label_visibility="collapsed")
+                    if values[i] and errors[i]:
+                        c[1].error(errors[i])
+
+        groups = item_catalog.groups()
+        for cat, cat_items in groups:
+            category_inputs(cat, cat_items)
+
         if st.button("一括登録", type="primary"):
-            if final_data:
-                df = load_data("expiry_records")
-                s_m = load_data("shop_master")
-                b_id = s_m[s_m["shop_name"] == info['name']]["branch_id"].values[0]
-                new_recs = []
-                for k, v in final_data.items():
-                    new_recs.append({
-                        "id": datetime.now().strftime('%Y%m%d%H%M%S')+str(k),
-                        "shop_id": info['name'],
-                        "branch_id": b_id,
-                        "category": v["cat"],
-                        "item_name": v["name"],
-                        "expiry_date": str(v["date"]),
-                        "input_date": str(date.today())
-                    })
-                save_data(pd.concat([df, pd.DataFrame(new_recs)]), "expiry_records")
-                st.success("完了"); st.balloons()
+            entered = [(it, st.session_state.get(f"inp_{it['item_id']}", "")) for _, cat_items in groups for it in cat_items]
+            entered = [(it, v) for it, v in entered if v]
+            if entered:
+                rows = pd.DataFrame([it for it, _ in entered])
+                dates, errors = validate_dates(pd.Series([v for _, v in entered], dtype=str), rows["input_type"])
+                ok = errors.eq("")
+                if (~ok).any():
+                    st.error(f"期限が正しくない {(~ok).sum()} 件は登録していません")
+                if ok.any() and append_data(expiry_records_for(info['name'], rows[ok].assign(expiry_date=dates[ok])), "expiry_records"):
+                    st.success("完了"); st.balloons()
 
 elif menu == "パスワード変更":
     st.header("🔑 パスワード変更")
     with st.form("pw_f"):
         new_pw = st.text_input("新パスワード", type="password")
         if st.form_submit_button("更新"):
-            u_df = load_data("user_master")
-            u_df.loc[u_df["id"] == info["id"], "password"] = new_pw
-            save_data(u_df, "user_master"); st.success("更新しました")
+            if update_data("user_master", {info["id"]: {"password": new_pw}}):
+                st.success("更新しました")
 
 elif menu in ["管轄者管理", "アイテム管理", "支部登録"]:
     st.header(f"⚙️ {menu}")
@@ -375,44 +472,87 @@ elif menu in ["管轄者管理", "アイテム管理", "支部登録"]:
             b_name = c2.text_input("支部名")
             b_pw = c3.text_input("PW")
             if st.form_submit_button("登録"):
-                save_data(pd.concat([u_all, pd.DataFrame([{
-                    "id": b_id, "password": b_pw, "role": "支部",
-                    "target_id": b_id, "name": b_name
-                }])]), "user_master")
-                save_data(pd.concat([b_all, pd.DataFrame([{
-                    "branch_id": b_id, "branch_name": b_name
-                }])]), "branch_master")
-                st.success("登録完了"); st.rerun()
+                used = sheets_using_id(b_id, ["user_master", "branch_master"])
+                if used:
+                    st.error(f"ID「{b_id}」はすでに使われています（{'、'.join(used)}）")
+                else:
+                    nu = pd.DataFrame([{
+                        "id": b_id, "password": b_pw, "role": "支部",
+                        "target_id": b_id, "name": b_name
+                    }])
+                    if append_data(nu, "user_master") and append_data(pd.DataFrame([{
+                        "branch_id": b_id, "branch_name": b_name
+                    }]), "branch_master"):
+                        st.success("登録完了"); st.rerun()
 
     elif menu == "アイテム管理":
         i_all = load_data("item_master")
+        if not i_all.empty and i_all["item_id"].duplicated().any():
+            # 重複した item_id の行は更新・削除できないので、先に振り直してもらう
+            st.warning(f"item_id が重複している商品があります（{i_all['item_id'].duplicated().sum()} 件）。振り直すまで更新・削除はできません")
+            if st.button("重複した item_id を振り直す"):
+                modify_data("item_master", renumber_duplicate_items)
+                st.rerun()
         with st.expander("➕ 追加"):
             with st.form("reg_i"):
                 c1, c2, c3 = st.columns(3)
-                cat = c1.selectbox("カテゴリ", ["冷蔵食材", "冷凍食材", "常温食材", "ドリンク", "ピックアップ"])
+                cat = c1.selectbox("カテゴリ", ITEM_CATEGORIES)
                 nm = c2.text_input("名")
-                tp = c3.radio("形式", ["年月日", "年月のみ"])
+                tp = c3.radio("形式", INPUT_TYPES)
                 if st.form_submit_button("保存"):
-                    save_data(pd.concat([i_all, pd.DataFrame([{
-                        "item_id": str(len(i_all)+1),
-                        "category": cat,
-                        "item_name": nm,
-                        "input_type": tp
-                    }])]), "item_master")
+                    # 採番は保存直前の最新データで行う（同時に追加されたら読み直してやり直す）
+                    modify_data("item_master", with_new_items(pd.DataFrame([{"category": cat, "item_name": nm, "input_type": tp}])))
                     st.rerun()
 
+        with st.expander("📤 ファイルから追加（CSV / XLSX）"):
+            if "item_upload_done" in st.session_state:
+                st.success(st.session_state.pop("item_upload_done"))
+            st.caption("列：カテゴリ・商品名・形式（年月日 / 年月のみ。省略すると年月日）")
+            up = st.file_uploader("ファイル", type=["csv", "xlsx"], key=f"item_upload_{st.session_state.get('item_upload_n', 0)}")
+            if up is not None:
+                try:
+                    src = read_upload(up)
+                except Exception as e:
+                    st.error(f"読み込みエラー: {e}")
+                    src = pd.DataFrame()
+                cols = ["category", "item_name", "input_type"]
+                src = src.assign(**{c: src[c].str.strip() if c in src else "" for c in cols})
+                src = src[src[cols].ne("").any(axis=1)]
+                src["input_type"] = src["input_type"].mask(src["input_type"].eq(""), "年月日")
+                key = src["category"] + "\t" + src["item_name"]
+                existing = i_all["category"].astype(str) + "\t" + i_all["item_name"].astype(str) if not i_all.empty else []
+                # 下にある判定ほど優先して表示する
+                errors = pd.Series("", index=src.index)
+                errors = errors.mask(key.duplicated(), "ファイル内で重複しています")
+                errors = errors.mask(key.isin(existing), "登録済みです")
+                errors = errors.mask(~src["input_type"].isin(INPUT_TYPES), "形式は 年月日 / 年月のみ です")
+                errors = errors.mask(~src["category"].isin(ITEM_CATEGORIES), "カテゴリが不正です")
+                errors = errors.mask(src["item_name"].eq(""), "商品名が空です")
+                ok = errors.eq("")
+                st.caption(f"追加できる行 {ok.sum()} 件 / エラー {(~ok).sum()} 件")
+                if (~ok).any():
+                    st.dataframe(pd.DataFrame({
+                        "行": src.index[~ok] + 2, "カテゴリ": src.loc[~ok, "category"], "商品名": src.loc[~ok, "item_name"],
+                        "形式": src.loc[~ok, "input_type"], "エラー": errors[~ok],
+                    }), hide_index=True, use_container_width=True)
+                if ok.any() and st.button(f"{ok.sum()} 件を追加（エラーの行は除く）", type="primary"):
+                    if modify_data("item_master", with_new_items(src.loc[ok, cols])):
+                        st.session_state["item_upload_done"] = f"{ok.sum()} 件を追加しました"
+                        st.session_state["item_upload_n"] = st.session_state.get("item_upload_n", 0) + 1
+                        st.rerun()
+
         for idx, row in i_all.iterrows():
             with st.container():
                 c = st.columns([1, 2, 0.5, 0.5])
                 c[0].write(row["category"])
                 new_nm = c[1].text_input("名", row["item_name"], key=f"i_nm_{idx}", label_visibility="collapsed")
+                # 失敗したとき（キーの重複など）はエラーを見せるため再描画しない
                 if c[2].button("🆙", key=f"i_up_{idx}"):
-                    i_all.at[idx, "item_name"] = new_nm
-                    save_data(i_all, "item_master")
-                    st.rerun()
+                    if update_data("item_master", {row["item_id"]: {"item_name": new_nm}}):
+                        st.rerun()
                 if c[3].button("🗑️", key=f"i_de_{idx}"):
-                    save_data(i_all.drop(idx), "item_master")
-                    st.rerun()
+                    if delete_data("item_master", [row["item_id"]]):
+                        st.rerun()
 
     elif menu == "管轄者管理":
         u_all = load_data("user_master")
@@ -425,14 +565,18 @@ elif menu in ["管轄者管理", "アイテム管理", "支部登録"]:
                 m_pw = st.text_input("PW")
                 sels = st.multiselect("担当店", my_shops["shop_name"].tolist())
                 if st.form_submit_button("登録"):
-                    save_data(pd.concat([u_all, pd.DataFrame([{
-                        "id": m_id,
-                        "password": m_pw,
-                        "role": "管轄者",
-                        "target_id": ",".join(sels),
-                        "name": m_name
-                    }])]), "user_master")
-                    st.rerun()
+                    if sheets_using_id(m_id, ["user_master"]):
+                        st.error(f"ID「{m_id}」はすでに使われています")
+                    else:
+                        nu = pd.DataFrame([{
+                            "id": m_id,
+                            "password": m_pw,
+                            "role": "管轄者",
+                            "target_id": ",".join(sels),
+                            "name": m_name
+                        }])
+                        if append_data(nu, "user_master"):
+                            st.rerun()
 
         m_list = u_all[u_all["role"] == "管轄者"]
         for idx, row in m_list.iterrows():
@@ -442,7 +586,9 @@ elif menu in ["管轄者管理", "アイテム管理", "支部登録"]:
                 c[1].write(row["name"])
                 c[2].write(row["target_id"])
                 if c[3].button("🗑️", key=f"m_de_{idx}"):
-                    save_data(u_all.drop(idx), "user_master")
-                    st.rerun()
-
+                    if delete_data("user_master", [row["id"]]):
+                        st.rerun()
 
+# --- 7. 描画時間の記録 ---
+# st.rerun() で打ち切られた回は記録しない（続けて走る次の回で記録される）
+record_render(menu)
@@ -0,0 +1,592 @@
+"""
+賞味期限管理システムのベンチマーク
+
+インメモリの偽スプレッドシート（[storage] backend = "memory"）に 1千 / 1万 / 10万件の
+期限データを用意し、streamlit.testing の AppTest で実際に画面を操作して、
+操作ごとの所要時間とAPI呼び出し回数（app.py の perf_metrics が数えた値）を測ります。
+
+  python benchmark.py                              # 1000,10000,100000 件で実行し、API回数が増えたら終了コード 1
+  python benchmark.py --sizes 1000 --out base.json # 結果をJSONに保存
+  python benchmark.py --baseline base.json         # 前回の結果と比べ、API回数が増えた・遅くなったら終了コード 1
+
+--baseline を付けないときは、リポジトリの benchmark_baseline.json とAPI回数だけを比べます
+（所要時間は計測する環境で変わるため、比べるのは --baseline か --tolerance を付けたときだけ）。
+API回数を減らしたときは --out benchmark_baseline.json で書き直してコミットします。
+
+書き込みキューの負荷試験だけは、AppTest のセッションを同時に動かせないため、
+画面を通さずに app.py と同じ kigen_data モジュールを使って複数スレッドから書き込みます。
+ストレージに残った内容と突き合わせ、消えた・重複した記録が1件でもあれば終了コード 1 にします。
+
+続けて、書き込みの途中の読み込み・アーカイブの失敗とやり直し・キーの重複・削除後の読み足しを
+故意に起こし、キャッシュと索引がストレージと食い違わないかを確かめます（食い違えば終了コード 1）。
+"""
+import argparse
+import json
+import logging
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import date, timedelta
+from pathlib import Path
+
+import pandas as pd
+import streamlit as st
+from streamlit.testing.v1 import AppTest
+
+APP = Path(__file__).with_name("app.py")
+BASELINE = Path(__file__).with_name("benchmark_baseline.json")
+CATEGORIES = ["冷蔵食材", "冷凍食材", "常温食材", "ドリンク"]
+N_BRANCHES, N_SHOPS, N_ITEMS = 5, 50, 80
+ZERO = {"calls": 0, "ms": 0, "api": 0}
+
+# 遅くなったと判定するときの最小差（ms）。小さな操作の揺れで落ちないようにする
+MIN_SLOWDOWN_MS = 50
+# API回数がスレッドの順番で変わる操作（書き込みのまとまり方・やり直しの回数）。API回数は比べない
+API_VARIES = ("書き込みキュー:",)
+
+
+# --- 1. テストデータ ---
+def make_seed(n_records, seed=1):
+    """マスタ類と n_records 件の期限データを、MemorySpreadsheet の初期値（シート名→値の表）で返す"""
+    rnd = random.Random(seed)
+    today = date.today()
+    users = [["id", "password", "role", "target_id", "name"], ["0001", "pw", "マスター", "", "本部"]]
+    branches = [["branch_id", "branch_name"]]
+    for b in range(N_BRANCHES):
+        bid = f"{1001 + b}"
+        branches.append([bid, f"支部{b + 1}"])
+        users.append([bid, "pw", "支部", bid, f"支部{b + 1}"])
+    shops = [["shop_id", "branch_id", "shop_name"]]
+    for i in range(N_SHOPS):
+        sid, name = f"{3001 + i}", f"店{i + 1:03d}"
+        shops.append([sid, branches[1 + i % N_BRANCHES][0], name])
+        users.append([sid, "pw", "店舗", name, name])
+    users.append(["2001", "pw", "管轄者", ",".join(s[2] for s in shops[1:6]), "管轄者1"])
+    items = [["item_id", "category", "item_name", "input_type"]]
+    for i in range(1, N_ITEMS + 1):
+        items.append([str(i), CATEGORIES[i % len(CATEGORIES)], f"商品{i:03d}", "年月のみ" if i % 5 == 0 else "年月日"])
+    records = [["id", "shop_id", "branch_id", "category", "item_name", "expiry_date", "input_date"]]
+    for n in range(n_records):
+        shop, item = rnd.choice(shops[1:]), rnd.choice(items[1:])
+        expiry = today + timedelta(days=rnd.randint(-60, 180))
+        records.append([f"B{n:09d}", shop[2], shop[1], item[1], item[2], str(expiry), str(expiry - timedelta(days=200))])
+    return {"user_master": users, "branch_master": branches, "shop_master": shops, "item_master": items, "expiry_records": records}
+
+
+def make_db_seed(seed):
+    """同期元（DB用スプレッドシート）の初期値。商品を1つ増やして、同期で1シートが書き換わるようにする"""
+    db = {n: seed[n] for n in ("user_master", "branch_master", "shop_master", "item_master")}
+    db["item_master"] = db["item_master"] + [[str(N_ITEMS + 1), CATEGORIES[0], "新商品", "年月日"]]
+    return db
+
+
+def write_seeds(workdir, n_records):
+    seed = make_seed(n_records)
+    paths = {"seed_path": workdir / f"seed_{n_records}.json", "db_seed_path": workdir / f"db_seed_{n_records}.json"}
+    for key, data in (("seed_path", seed), ("db_seed_path", make_db_seed(seed))):
+        paths[key].write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+    return {k: str(v) for k, v in paths.items()}
+
+
+def bench_secrets(paths):
+    return {
+        "storage": {"backend": "memory", **paths},
+        "db_spreadsheet_id": "benchmark",
+        "sync": {"interval": 0},
+    }
+
+
+# --- 2. 画面操作のシナリオ ---
+class Session:
+    """
+    AppTest 1セッション分。操作ごとに所要時間と、perf_log に残る累計の差を results に記録する
+
+    perf_metrics の累計はプロセス全体で共有なので、新しいセッションの最初の操作は
+    直前のセッションが最後に記録した累計（last）との差を取る。
+    """
+
+    def __init__(self, secrets, results, last):
+        self.at = AppTest.from_file(str(APP), default_timeout=600)
+        self.at.secrets.update(secrets)
+        self.results = results
+        self.last = last
+
+    def step(self, name, action=None):
+        before = self.last["totals"]
+        t = time.perf_counter()
+        if action:
+            action(self.at)
+        self.at.run()
+        ms = (time.perf_counter() - t) * 1000
+        if self.at.exception:
+            raise RuntimeError(f"{name}: {self.at.exception[0].value}")
+        after = self.last["totals"] = self.at.session_state["perf_log"][-1]["totals"]
+        self.results[name] = {
+            "ms": round(ms, 1),
+            "api": after["api"] - before["api"],
+            "storage_calls": after["calls"] - before["calls"],
+        }
+        return self.at
+
+    def login(self, name, uid):
+        return self.step(name, lambda at: (at.text_input[0].input(uid), at.text_input[1].input("pw"), at.button[0].click()))
+
+    def menu(self, name, label):
+        return self.step(name, lambda at: at.sidebar.radio[0].set_value(label))
+
+
+def _widget(widgets, label):
+    return next(w for w in widgets if w.label.startswith(label))
+
+
+def run_scenarios(secrets):
+    results, last = {}, {"totals": ZERO}
+
+    # マスター：起動（キャッシュなし）→ ログイン → 期限確認 → エクセル発行 → 更新（同期）
+    s = Session(secrets, results, last)
+    s.step("起動（キャッシュなし）")
+    s.login("ログイン→期限確認:マスター", "0001")
+    s.step("期限確認:マスター（再描画）")
+    s.menu("エクセル発行:表示", "エクセル発行")
+    s.step("エクセル発行:全期間", lambda at: _widget(at.radio, "対象期間").set_value("全期間"))
+    s.step("エクセル発行:XLSX作成", lambda at: _widget(at.button, "📊").click())
+    s.step("更新:同期あり", lambda at: _widget(at.button, "更新").click())
+    sync = s.at.session_state["sync_result"]
+    if sync["state"] != "完了" or sync["report"].get("item_master", {}).get("status") != "更新":
+        raise RuntimeError(f"同期が期待どおりに動いていません: {sync}")
+    s.step("更新:変更なし", lambda at: _widget(at.button, "更新").click())
+
+    # 支部・管轄者：ログイン直後が期限確認
+    for uid, role in (("1001", "支部"), ("2001", "管轄者")):
+        s = Session(secrets, results, last)
+        s.step(f"ログイン画面:{role}")
+        s.login(f"ログイン→期限確認:{role}", uid)
+
+    # 店舗：ログイン直後は期限入力。一覧を見てから一括登録する
+    s = Session(secrets, results, last)
+    s.step("ログイン画面:店舗")
+    s.login("ログイン→期限入力:店舗", "3001")
+    s.menu("期限確認:店舗", "期限一覧・編集")
+    s.menu("期限入力:店舗", "期限入力")
+
+    def fill(at):
+        for i in range(1, 21):
+            at.text_input(key=f"inp_{i}").input("203012" if i % 5 == 0 else "20301231")
+        _widget(at.button, "一括登録").click()
+    s.step("一括登録:20件", fill)
+    if "完了" not in [m.value for m in s.at.success]:
+        raise RuntimeError("一括登録が完了していません")
+    return results
+
+
+# --- 3. 書き込みキューの負荷試験 ---
+def reset_data_layer():
+    """次の AppTest の実行で kigen_data を読み込み直させる（共有オブジェクトを新しいデータで作り直す）"""
+    st.cache_resource.clear()
+    sys.modules.pop("kigen_data", None)
+
+
+def _concurrently(threads, fn):
+    """fn(スレッド番号) を threads 本のスレッドで同時に動かし、全部終わるまでの時間（ms）を返す"""
+    workers = [threading.Thread(target=fn, args=(i,)) for i in range(threads)]
+    t = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return (time.perf_counter() - t) * 1000
+
+
+def _stored_column(kigen_data, sheet_name, col):
+    values = kigen_data.storage.get_values(sheet_name)
+    k = values[0].index(col)
+    return [r[k] for r in values[1:]]
+
+
+def _records(kigen_data, shop, n, expiry="2030-12-31"):
+    """expiry_records に追加するレコード n 件（id は record_ids で発行）"""
+    today = str(date.today())
+    return [{
+        "id": rid, "shop_id": shop, "branch_id": "1001", "category": CATEGORIES[0],
+        "item_name": "商品001", "expiry_date": expiry, "input_date": today,
+    } for rid in kigen_data.record_ids.new(n)]
+
+
+def run_append_load(kigen_data, threads=16, per_thread=20, rows=5):
+    """一括登録の同時実行。送った id がすべて1回ずつストレージに残り、キャッシュとも一致するかを確かめる"""
+    write_queue, perf_metrics = kigen_data.write_queue, kigen_data.perf_metrics
+    kigen_data.load_data("expiry_records")  # キャッシュに載った状態で測る（書き込みはキャッシュへの差分適用も含む）
+    sent = [[] for _ in range(threads)]
+
+    def worker(t):
+        for _ in range(per_thread):
+            recs = _records(kigen_data, f"店{t + 1:03d}", rows)
+            write_queue.submit("expiry_records", "append", recs)
+            sent[t].extend(r["id"] for r in recs)
+
+    before, stats = perf_metrics.totals(), dict(write_queue.stats)
+    ms = _concurrently(threads, worker)
+    after = perf_metrics.totals()
+    stored = Counter(_stored_column(kigen_data, "expiry_records", "id"))
+    cached = kigen_data.load_data("expiry_records")
+    return {
+        "ms": round(ms, 1), "api": after["api"] - before["api"], "storage_calls": after["calls"] - before["calls"],
+        "ops": write_queue.stats["ops"] - stats["ops"], "batches": write_queue.stats["batches"] - stats["batches"],
+        "lost": sum(rid not in stored for s in sent for rid in s),
+        "duplicates": sum(c - 1 for c in stored.values()),
+        "cache_diff": abs(len(cached) - sum(stored.values())) + int(cached["id"].duplicated().sum()),
+    }
+
+
+def run_modify_load(kigen_data, threads=8, per_thread=5):
+    """商品の追加（modify_data による読み込み → 書き戻し）の同時実行
+
+    WriteConflict で読み直した分は conflicts に、やり直しきれずに利用者へエラーを出した分は gave_up に数える。
+    保存できたと返したのにシートにない商品（lost）と、item_id の重複（duplicates）は 0 でなければならない。
+    """
+    write_queue, perf_metrics = kigen_data.write_queue, kigen_data.perf_metrics
+    saved, gave_up = [], []
+
+    def worker(t):
+        for i in range(per_thread):
+            name = f"負荷試験{t:02d}-{i:02d}"
+            new = pd.DataFrame({"category": [CATEGORIES[0]], "item_name": [name], "input_type": ["年月日"]})
+            (saved if kigen_data.modify_data("item_master", kigen_data.with_new_items(new)) else gave_up).append(name)
+
+    before, stats = perf_metrics.totals(), dict(write_queue.stats)
+    ms = _concurrently(threads, worker)
+    after = perf_metrics.totals()
+    names = set(_stored_column(kigen_data, "item_master", "item_name"))
+    item_ids = Counter(_stored_column(kigen_data, "item_master", "item_id"))
+    return {
+        "ms": round(ms, 1), "api": after["api"] - before["api"], "storage_calls": after["calls"] - before["calls"],
+        "ops": write_queue.stats["ops"] - stats["ops"], "conflicts": write_queue.stats["conflicts"] - stats["conflicts"],
+        "gave_up": len(gave_up),
+        "lost": sum(name not in names for name in saved),
+        "duplicates": sum(c - 1 for c in item_ids.values()),
+    }
+
+
+def run_write_load():
+    # 直前のシナリオで app.py が読み込んだ kigen_data（同じ storage / write_queue）をそのまま使う
+    import kigen_data
+    return {
+        "書き込みキュー:追加 16スレッド×20回": run_append_load(kigen_data),
+        "書き込みキュー:modify_data 8スレッド×5回": run_modify_load(kigen_data),
+    }
+
+
+# --- 4. 整合性の確認 ---
+# どれも書き込みや読み込みの失敗・割り込みを故意に起こし、食い違いを文章で返す（なければ空文字）
+CHECK_SHOP = "整合性確認店"
+
+
+class _Inject:
+    """ストレージの実体（kigen_data.storage.inner）のメソッドを、with の間だけ差し替える"""
+
+    def __init__(self, kigen_data, name, make):
+        self.inner, self.name = kigen_data.storage.inner, name
+        self.patched = make(getattr(self.inner, name))
+
+    def __enter__(self):
+        setattr(self.inner, self.name, self.patched)
+
+    def __exit__(self, *exc):
+        delattr(self.inner, self.name)
+
+
+class _NoCache:
+    """with の間はキャッシュのTTLを0にして、load_data にストレージから読み直させる（差分の読み足しも含む）"""
+
+    def __init__(self, kigen_data):
+        self.cache = kigen_data.sheet_cache
+
+    def __enter__(self):
+        self.ttl, self.cache.ttl = self.cache.ttl, 0
+
+    def __exit__(self, *exc):
+        self.cache.ttl = self.ttl
+
+
+def _compare_records(kigen_data, shop=None):
+    """キャッシュ（load_data）と店舗の索引が、ストレージの expiry_records と同じ id を同じ順に持つか"""
+    values = kigen_data.storage.get_values("expiry_records")
+    k, s = values[0].index("id"), values[0].index("shop_id")
+    stored = [r[k] for r in values[1:]]
+    problems = []
+    cached = kigen_data.load_data("expiry_records")["id"].tolist()
+    if cached != stored:
+        problems.append(f"キャッシュ {len(cached)} 行（重複 {len(cached) - len(set(cached))}）/ ストレージ {len(stored)} 行")
+    if shop is not None:
+        indexed = kigen_data.record_index.for_shops([shop])["id"].tolist()
+        expected = [r[k] for r in values[1:] if r[s] == shop]
+        if indexed != expected:
+            problems.append(f"索引 {len(indexed)} 行 / ストレージ {len(expected)} 行（{shop}）")
+    return "、".join(problems)
+
+
+def check_read_during_write(kigen_data, n=5):
+    """ストレージへの追加の直後（キャッシュへ反映する前）に読み込みと索引の引き直しが入っても、行が二重にならない"""
+    def append_then_read(append):
+        def call(sheet_name, records):
+            append(sheet_name, records)
+            with _NoCache(kigen_data):
+                kigen_data.load_data("expiry_records")
+                kigen_data.record_index.for_shops([CHECK_SHOP])
+        return call
+
+    kigen_data.load_data("expiry_records")
+    with _Inject(kigen_data, "append_records", append_then_read):
+        kigen_data.write_queue.submit("expiry_records", "append", _records(kigen_data, CHECK_SHOP, n))
+    return _compare_records(kigen_data, CHECK_SHOP)
+
+
+def check_archive_retry(kigen_data, n=80, done=3):
+    """アーカイブを読めなかった年は移さずに次回へ回し、やり直しで重複なく移し終える
+
+    前回の実行が途中で止まり、done 件だけアーカイブに追加済みの状態から始める。
+    """
+    job, write_queue = kigen_data.retention_job, kigen_data.write_queue
+    name = f"{kigen_data.ARCHIVE_PREFIX}2001"
+    recs = _records(kigen_data, CHECK_SHOP, n, expiry="2001-06-30")
+    write_queue.submit("expiry_records", "append", recs)
+    write_queue.submit(name, "append", recs[:done])
+    kigen_data.sheet_cache.invalidate(name)
+
+    def fail_archive(get_values):
+        def call(sheet_name):
+            if sheet_name == name:
+                raise RuntimeError("読み込みの失敗（故意）")
+            return get_values(sheet_name)
+        return call
+
+    job.last_run = None
+    problems = []
+    with _Inject(kigen_data, "get_values", fail_archive):
+        first = job.run()
+    if first or job.last_run is not None:
+        problems.append(f"読めなかった回に {first} を移し、last_run={job.last_run}")
+    second = job.run()
+    if second.get(name) != n or job.last_run is None:
+        problems.append(f"やり直しで {second} を移し、last_run={job.last_run}")
+    ids = {r["id"] for r in recs}
+    archived = Counter(i for i in _stored_column(kigen_data, name, "id") if i in ids)
+    hot = ids & set(_stored_column(kigen_data, "expiry_records", "id"))
+    if len(archived) != n or sum(archived.values()) != n or hot:
+        problems.append(f"アーカイブ {sum(archived.values())} 行（{len(archived)} 種類）/ expiry_records に残った {len(hot)} 件")
+    return "、".join(problems + [_compare_records(kigen_data)]).strip("、")
+
+
+def check_archive_concurrent(kigen_data, n=30):
+    """アーカイブを2つ同時に実行しても、2つ目は待たずに None を返し、記録は1回だけ移る"""
+    job = kigen_data.retention_job
+    name = f"{kigen_data.ARCHIVE_PREFIX}2002"
+    recs = _records(kigen_data, CHECK_SHOP, n, expiry="2002-06-30")
+    kigen_data.write_queue.submit("expiry_records", "append", recs)
+
+    def slow_read(get_values):
+        def call(sheet_name):
+            time.sleep(0.2)  # 2つ目の実行がアーカイブを読み終える前に始まるようにする
+            return get_values(sheet_name)
+        return call
+
+    runs = [None, None]
+    with _Inject(kigen_data, "get_values", slow_read):
+        _concurrently(2, lambda i: runs.__setitem__(i, job.run()))
+    problems = []
+    if sorted(runs, key=lambda r: r is None) != [{name: n}, None]:
+        problems.append(f"同時に実行した結果 {runs}")
+    ids = {r["id"] for r in recs}
+    archived = [i for i in _stored_column(kigen_data, name, "id") if i in ids]
+    if len(archived) != n or set(archived) != ids:
+        problems.append(f"アーカイブ {len(archived)} 行（{len(set(archived))} 種類）/ {n} 件")
+    return "、".join(problems)
+
+
+def check_duplicate_key(kigen_data):
+    """同じ id が2行あるとき、更新・削除は1行も書かずに DuplicateKey になり、キャッシュもストレージと同じまま"""
+    rec = _records(kigen_data, CHECK_SHOP, 1)[0]
+    write_queue = kigen_data.write_queue
+    write_queue.submit("expiry_records", "append", [rec, dict(rec, item_name="商品002")])
+    problems = []
+    for kind, payload in (("update", {rec["id"]: {"item_name": "商品003"}}), ("delete", [rec["id"]])):
+        try:
+            write_queue.submit("expiry_records", kind, payload)
+            problems.append(f"{kind} が通った")
+        except kigen_data.DuplicateKey:
+            pass
+    names = sorted(r["item_name"] for r in kigen_data.load_data("expiry_records").to_dict("records") if r["id"] == rec["id"])
+    if names != ["商品001", "商品002"]:
+        problems.append(f"キャッシュの行 {names}")
+
+    # 書き込み中に届いた削除はまとめて書かれる。重複した id と同じ回にまとめられた、別の利用者の削除は通る
+    other = _records(kigen_data, CHECK_SHOP, 1)
+    write_queue.submit("expiry_records", "append", other)
+    outcome = {}
+
+    def delete(key):
+        try:
+            outcome[key] = write_queue.submit("expiry_records", "delete", [key])
+        except kigen_data.DuplicateKey:
+            outcome[key] = "DuplicateKey"
+
+    def slow_append(append):
+        def call(sheet_name, records):
+            time.sleep(0.2)
+            append(sheet_name, records)
+        return call
+
+    with _Inject(kigen_data, "append_records", slow_append):
+        busy = threading.Thread(target=write_queue.submit, args=("expiry_records", "append", _records(kigen_data, CHECK_SHOP, 1)))
+        busy.start()
+        time.sleep(0.05)
+        _concurrently(2, lambda i: delete([rec["id"], other[0]["id"]][i]))
+        busy.join()
+    if outcome != {rec["id"]: "DuplicateKey", other[0]["id"]: 1}:
+        problems.append(f"同じ回にまとめた削除の結果 {outcome}")
+    return "、".join(problems + [_compare_records(kigen_data, CHECK_SHOP)]).strip("、")
+
+
+def check_delta_after_delete(kigen_data, n=6):
+    """行を消した後に読み足しても表がストレージと一致する（このアプリからの削除と、他端末での削除・追加）"""
+    recs = _records(kigen_data, CHECK_SHOP, n)
+    kigen_data.write_queue.submit("expiry_records", "append", recs)
+    kigen_data.write_queue.submit("expiry_records", "delete", [r["id"] for r in recs[1:n - 1]])
+    problems = []
+    with _NoCache(kigen_data):
+        if p := _compare_records(kigen_data, CHECK_SHOP):
+            problems.append(f"アプリからの削除の後: {p}")
+    # 他端末で先頭の行を消して1行足した（行数は同じで、最終行のキーが変わる）
+    worksheet = kigen_data.storage.inner.book.worksheet("expiry_records")
+    worksheet.delete_rows(2)
+    worksheet.append_rows([list(_records(kigen_data, CHECK_SHOP, 1)[0].values())])
+    with _NoCache(kigen_data):
+        if p := _compare_records(kigen_data, CHECK_SHOP):
+            problems.append(f"他端末での削除・追加の後: {p}")
+    return "、".join(problems)
+
+
+CHECKS = {
+    "整合性:書き込み中の読み込み": check_read_during_write,
+    "整合性:アーカイブのやり直し": check_archive_retry,
+    "整合性:アーカイブの同時実行": check_archive_concurrent,
+    "整合性:キーの重複": check_duplicate_key,
+    "整合性:削除後の読み足し": check_delta_after_delete,
+}
+
+
+def run_checks():
+    import kigen_data
+    perf_metrics = kigen_data.perf_metrics
+    results = {}
+    for name, check in CHECKS.items():
+        before = perf_metrics.totals()
+        t = time.perf_counter()
+        try:
+            problem = check(kigen_data)
+        except Exception as e:
+            problem = f"{type(e).__name__}: {e}"
+        after = perf_metrics.totals()
+        results[name] = {
+            "ms": round((time.perf_counter() - t) * 1000, 1), "api": after["api"] - before["api"],
+            "storage_calls": after["calls"] - before["calls"], "problem": problem,
+        }
+    return results
+
+
+# --- 5. 実行・前回との比較 ---
+def run(sizes, workdir):
+    results = {}
+    for n in sizes:
+        print(f"== {n} 件", file=sys.stderr)
+        secrets = bench_secrets(write_seeds(workdir, n))
+        reset_data_layer()
+        res = run_scenarios(secrets)
+        res.update(run_write_load())
+        res.update(run_checks())
+        results[str(n)] = res
+    reset_data_layer()
+    return results
+
+
+def compare(results, baseline, tolerance=None):
+    """API回数が増えた、または所要時間が baseline × (1 + tolerance) を超えた操作を返す（tolerance が None なら時間は比べない）"""
+    regressions = []
+    for size, scenarios in results.items():
+        for name, cur in scenarios.items():
+            base = baseline.get(size, {}).get(name)
+            if not base:
+                continue
+            if cur["api"] > base["api"] and not name.startswith(API_VARIES):
+                regressions.append(f"{size}件 {name}: API {base['api']} → {cur['api']} 回")
+            if tolerance is None:
+                continue
+            if cur["ms"] > base["ms"] * (1 + tolerance) and cur["ms"] - base["ms"] > MIN_SLOWDOWN_MS:
+                regressions.append(f"{size}件 {name}: {base['ms']:.0f} → {cur['ms']:.0f} ms")
+    return regressions
+
+
+def integrity_problems(results):
+    """負荷試験で消えた・重複した記録と、整合性の確認で見つかった食い違い（基準の結果がなくても、1件でもあれば失敗）"""
+    problems = []
+    for size, scenarios in results.items():
+        for name, r in scenarios.items():
+            if r.get("lost") or r.get("duplicates") or r.get("cache_diff"):
+                problems.append(f"{size}件 {name}: 消失 {r['lost']} / 重複 {r['duplicates']} / キャッシュとの差 {r.get('cache_diff', 0)}")
+            if r.get("problem"):
+                problems.append(f"{size}件 {name}: {r['problem']}")
+    return problems
+
+
+def summary(results):
+    frame = pd.DataFrame({
+        (size, col): {name: r.get(col, "") for name, r in scenarios.items()}
+        for size, scenarios in results.items() for col in ("ms", "api", "lost")
+    })
+    return frame.to_string()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="賞味期限管理システムのベンチマーク")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="期限データの件数（カンマ区切り）")
+    parser.add_argument("--out", help="結果を書き出すJSONファイル")
+    parser.add_argument("--baseline", help=f"比較する前回の結果（--out で書き出したJSON。既定 {BASELINE.name} とAPI回数だけ比べる）")
+    parser.add_argument("--tolerance", type=float, help="所要時間の許容増加率（--baseline を付けたときの既定 0.5 = 1.5倍まで）")
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.WARNING)  # 画面の外で kigen_data を使うときの「ScriptRunContext がない」警告を抑える
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    with tempfile.TemporaryDirectory() as tmp:
+        results = run(sizes, Path(tmp))
+    print(summary(results))
+
+    report = {
+        "at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "versions": {"python": sys.version.split()[0], "pandas": pd.__version__, "streamlit": st.__version__},
+        "results": results,
+    }
+    if args.out:
+        Path(args.out).write_text(json.dumps(report, ensure_ascii=False, indent=1), encoding="utf-8")
+    problems = integrity_problems(results)
+    for p in problems:
+        print("不整合:", p)
+    path, tolerance = BASELINE, args.tolerance
+    if args.baseline:
+        path, tolerance = Path(args.baseline), 0.5 if args.tolerance is None else args.tolerance
+    elif not path.exists():
+        print(f"{path.name} がないため、前回の結果とは比べません")
+        return 1 if problems else 0
+    baseline = json.loads(path.read_text(encoding="utf-8"))["results"]
+    regressions = compare(results, baseline, tolerance)
+    for r in regressions:
+        print("悪化:", r)
+    if not regressions:
+        print(f"{path.name} から悪化はありません")
+    return 1 if regressions or problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1917 @@
+"""
+賞味期限管理システムの接続・データ操作（app.py の 1〜2章）
+
+ストレージ・読み込みキャッシュ・書き込みキュー・索引など、画面を持たない部分です。
+共有するオブジェクト（storage / sheet_cache / write_queue など）は st.cache_resource で作り、
+import したときに1度だけ用意します。app.py と benchmark.py から import して使います。
+"""
+import streamlit as st
+import pandas as pd
+import numpy as np
+import gspread
+import xlsxwriter
+from xlsxwriter.utility import xl_col_to_name
+from google.oauth2.service_account import Credentials
+from datetime import date, datetime, timedelta
+import re
+import io
+import os
+import hashlib
+import hmac
+import json
+import sqlite3
+import threading
+import time
+import bisect
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Future
+import queue
+
+# --- 1. 接続・認証設定 ---
+@st.cache_resource
+def get_gspread_client():
+    info = dict(st.secrets["gcp_service_account"])
+    scopes = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
+    creds = Credentials.from_service_account_info(info, scopes=scopes)
+    return gspread.authorize(creds)
+
+spreadsheet_id = "10SPAlhEavpSZzHr2iCgu3U_gaaW6IHWgvjNTdvSWY9A"
+
+# --- 1-1. ストレージバックエンド ---
+# 画面側は load_data / save_data だけを使い、実体は secrets.toml の [storage] で切り替えます
+#   [storage]
+#   backend = "gspread"      # gspread（既定） / sqlite / memory
+#   sqlite_path = "kigen.db" # backend = "sqlite" のときのDBファイル
+#   seed_path = "seed.json"  # backend = "memory" のときの初期データ（任意）
+#   db_seed_path = "db.json" # backend = "memory" のときのDB用スプレッドシートの中身（同期の検証用・任意）
+
+# 行単位の更新・削除で行を特定するキー列
+ROW_KEYS = {
+    "expiry_records": "id",
+    "item_master": "item_id",
+    "shop_master": "shop_id",
+    "branch_master": "branch_id",
+    "user_master": "id",
+}
+
+class DuplicateKey(Exception):
+    """行単位の更新・削除のキーが複数の行に当たったことを表す（どの行か決められないので書き込まない）"""
+
+    def __init__(self, sheet_name, keys):
+        super().__init__(f"{sheet_name} の {ROW_KEYS.get(sheet_name)} が重複している行があります: {', '.join(map(str, keys))}")
+        self.sheet_name = sheet_name
+        self.keys = list(keys)
+
+def pad_values(values, rows=0, cols=0):
+    """行の長さをそろえた2次元リストを返す（rows 行 / cols 列に満たない分は空白で埋める）"""
+    width = max([cols] + [len(r) for r in values])
+    out = [list(r) + [""] * (width - len(r)) for r in values]
+    out.extend([[""] * width for _ in range(rows - len(out))])
+    return out
+
+class MemoryWorksheet:
+    """gspread.Worksheet の読み書きAPIを模したインメモリ版（負荷試験・ローカル検証用）"""
+
+    def __init__(self, title, rows=1000, cols=26, sheet_id=0):
+        self.title = title
+        self.id = sheet_id
+        self.row_count = int(rows)
+        self.col_count = int(cols)
+        self._values = []
+
+    def get_all_values(self):
+        # 本物と同じく末尾の空行は返さず、各行の長さをそろえる
+        n = len(self._values)
+        while n and not any(self._values[n - 1]):
+            n -= 1
+        return pad_values(self._values[:n])
+
+    def get(self, range_name, **kwargs):
+        # "A5:G" のように終わりの行を省いた範囲は、最後の行までとみなす
+        start, _, end = range_name.partition(":")
+        r1, c1 = gspread.utils.a1_to_rowcol(start)
+        if end and not end[-1].isdigit():
+            end += str(max(len(self._values), r1))
+        r2, c2 = gspread.utils.a1_to_rowcol(end) if end else (r1, c1)
+        return [list(r[c1 - 1:c2]) for r in self._values[r1 - 1:r2]]
+
+    def batch_get(self, ranges, **kwargs):
+        return [self.get(r) for r in ranges]
+
+    def update(self, values, range_name=None, **kwargs):
+        # 書き込み開始位置は "A1" / "B3:D3" のような A1 表記の左上セルで決まる
+        start_row, start_col = 1, 1
+        if range_name:
+            start_row, start_col = gspread.utils.a1_to_rowcol(range_name.split(":")[0])
+        for i, r in enumerate(values):
+            row_idx = start_row - 1 + i
+            while len(self._values) <= row_idx:
+                self._values.append([])
+            row = self._values[row_idx]
+            end = start_col - 1 + len(r)
+            if len(row) < end:
+                row.extend([""] * (end - len(row)))
+            row[start_col - 1:end] = ["" if v is None else str(v) for v in r]
+        return {"updatedRows": len(values)}
+
+    def batch_update(self, data, **kwargs):
+        for d in data:
+            self.update(d["values"], d["range"])
+        return {"totalUpdatedCells": sum(len(r) for d in data for r in d["values"])}
+
+    def append_rows(self, values, **kwargs):
+        start = len(self._values) + 1
+        self._values.extend([["" if v is None else str(v) for v in r] for r in values])
+        end = gspread.utils.rowcol_to_a1(len(self._values), max([len(r) for r in values] + [1]))
+        return {"updates": {"updatedRange": f"'{self.title}'!A{start}:{end}", "updatedRows": len(values)}}
+
+    def delete_rows(self, start_index, end_index=None):
+        del self._values[start_index - 1:(end_index or start_index)]
+
+    def resize(self, rows=None, cols=None):
+        self.row_count = int(rows or self.row_count)
+        self.col_count = int(cols or self.col_count)
+
+    def clear(self):
+        self._values = []
+
+class MemorySpreadsheet:
+    """gspread.Spreadsheet の worksheet / add_worksheet を模したインメモリ版"""
+
+    def __init__(self, seed=None):
+        self._worksheets = {}
+        for name, values in (seed or {}).items():
+            self.add_worksheet(title=name, rows=len(values), cols=20).update(values)
+
+    def worksheet(self, title):
+        try:
+            return self._worksheets[title]
+        except KeyError:
+            raise gspread.exceptions.WorksheetNotFound(title)
+
+    def worksheets(self):
+        return list(self._worksheets.values())
+
+    def add_worksheet(self, title, rows, cols, **kwargs):
+        ws = MemoryWorksheet(title, rows, cols, sheet_id=len(self._worksheets))
+        self._worksheets[title] = ws
+        return ws
+
+    def batch_update(self, body):
+        # 行の削除（deleteDimension）だけに対応。本物と同じくリクエストは先頭から順に適用する
+        sheets = {ws.id: ws for ws in self._worksheets.values()}
+        for req in body["requests"]:
+            rng = req["deleteDimension"]["range"]
+            sheets[rng["sheetId"]].delete_rows(rng["startIndex"] + 1, rng["endIndex"])
+        return {"replies": [{} for _ in body["requests"]]}
+
+    def _split_range(self, range_name):
+        name, sep, cells = range_name.rpartition("!")
+        if not sep:
+            name, cells = range_name, ""
+        if name.startswith("'"):
+            name = name[1:-1].replace("''", "'")
+        return self.worksheet(name), cells
+
+    def values_batch_get(self, ranges, params=None):
+        out = []
+        for range_name in ranges:
+            ws, cells = self._split_range(range_name)
+            values = ws.get(cells) if cells else ws.get_all_values()
+            # 本物のAPIと同じく、末尾の空セル・空行は返さない
+            rows = []
+            for r in values:
+                r = list(r)
+                while r and r[-1] == "":
+                    r.pop()
+                rows.append(r)
+            while rows and not rows[-1]:
+                rows.pop()
+            out.append({"range": range_name, "values": rows} if rows else {"range": range_name})
+        return {"valueRanges": out}
+
+    def values_batch_update(self, body=None):
+        for d in body["data"]:
+            ws, cells = self._split_range(d["range"])
+            ws.update(d["values"], cells or None)
+        return {"totalUpdatedSheets": len(body["data"])}
+
+    def values_batch_clear(self, params=None, body=None):
+        for range_name in body["ranges"]:
+            self._split_range(range_name)[0].clear()
+        return {"clearedRanges": body["ranges"]}
+
+class SheetsStorage:
+    """スプレッドシート（gspread もしくは MemorySpreadsheet）をそのまま使うバックエンド
+
+    行単位の書き込み用に シート名 → {列名, キー → [行番号, ...]} のインデックスを保持します。
+    インデックスは全件読込のたびに作り直し、更新・削除の直前には対象行のキーセルだけを
+    batch_get でまとめて読んで一致するか確かめます（他端末の書き込みでずれていたら読み直し）。
+    batch_get の範囲はURLに載るので、VERIFY_CELLS 件を超えるときはキー列を1回で読んで確かめます。
+    読み直しても複数の行に当たるキーがあれば、1行も書かずに DuplicateKey を送出します。
+    """
+
+    # 対象行のキーセルを1つずつ指定して確かめる上限（1セルでURLが40バイトほど長くなる）
+    VERIFY_CELLS = 100
+
+    def __init__(self, book):
+        self.book = book
+        self.lock = threading.RLock()
+        self._index = {}
+        self._sheets = {}
+        self._names = None
+
+    def _worksheet(self, sheet_name, create=False):
+        # worksheet() は毎回メタデータを取得するので、一度取ったものは使い回す
+        if sheet_name not in self._sheets:
+            try:
+                self._sheets[sheet_name] = self.book.worksheet(sheet_name)
+            except gspread.exceptions.WorksheetNotFound:
+                if not create:
+                    raise
+                self._sheets[sheet_name] = self.book.add_worksheet(title=sheet_name, rows="2000", cols="20")
+                if self._names is not None:
+                    self._names.append(sheet_name)
+        return self._sheets[sheet_name]
+
+    def _fit_grid(self, worksheet, values):
+        # 書き込む範囲がシートの行数・列数を超えるときは先に広げる（update はグリッドの外に書けない）
+        rows, cols = len(values), max([len(r) for r in values] + [0])
+        if rows > worksheet.row_count or cols > worksheet.col_count:
+            worksheet.resize(rows=max(rows + 1000, worksheet.row_count), cols=max(cols, worksheet.col_count))
+
+    def sheet_names(self):
+        """ワークシート名の一覧（一度だけ取得し、以降はこのプロセスで作ったシートを足していく）"""
+        with self.lock:
+            if self._names is None:
+                worksheets = self.book.worksheets()
+                self._names = [ws.title for ws in worksheets]
+                for ws in worksheets:
+                    self._sheets.setdefault(ws.title, ws)
+            return list(self._names)
+
+    def _build_index(self, sheet_name, values):
+        cols = [c.strip() for c in values[0]] if values else []
+        key_col = ROW_KEYS.get(sheet_name)
+        rows = {}
+        if key_col in cols:
+            k = cols.index(key_col)
+            for i, r in enumerate(values[1:], start=2):
+                if len(r) > k:
+                    rows.setdefault(r[k], []).append(i)
+        self._index[sheet_name] = {
+            "cols": cols, "rows": rows,
+            "n": len(values), "width": max([len(r) for r in values] + [0]),
+        }
+        return self._index[sheet_name]
+
+    def _get_index(self, worksheet, sheet_name):
+        if sheet_name not in self._index:
+            return self._build_index(sheet_name, worksheet.get_all_values())
+        return self._index[sheet_name]
+
+    @staticmethod
+    def _add_row(idx, key, row):
+        rows = idx["rows"].setdefault(key, [])
+        if row not in rows:
+            rows.append(row)
+
+    def _locate(self, worksheet, sheet_name, keys):
+        """キーの一覧 → {キー: 行番号}（見つからないキーは含めない。複数の行に当たるキーがあれば DuplicateKey）"""
+        idx = self._get_index(worksheet, sheet_name)
+        key_col = ROW_KEYS.get(sheet_name)
+        if key_col not in idx["cols"]:
+            return idx, {}
+        k = idx["cols"].index(key_col) + 1
+        keys = list(dict.fromkeys(keys))
+        hits = {key: idx["rows"][key] for key in keys if idx["rows"].get(key)}
+        if hits and len(hits) == len(keys) and all(len(r) == 1 for r in hits.values()):
+            found = {key: r[0] for key, r in hits.items()}
+            if len(found) <= self.VERIFY_CELLS:
+                cells = worksheet.batch_get([gspread.utils.rowcol_to_a1(r, k) for r in found.values()])
+                if all(c and c[0] and c[0][0] == key for c, key in zip(cells, found)):
+                    return idx, found
+            else:
+                col = gspread.utils.rowcol_to_a1(1, k).rstrip("0123456789")
+                column = [r[0] if r else "" for r in worksheet.get(f"{col}2:{col}")]
+                if all(r - 2 < len(column) and column[r - 2] == key for key, r in found.items()):
+                    return idx, found
+        idx = self._build_index(sheet_name, worksheet.get_all_values())
+        hits = {key: idx["rows"][key] for key in keys if idx["rows"].get(key)}
+        dups = [key for key, r in hits.items() if len(r) > 1]
+        if dups:
+            raise DuplicateKey(sheet_name, dups)
+        return idx, {key: r[0] for key, r in hits.items()}
+
+    def get_values(self, sheet_name):
+        with self.lock:
+            values = self._worksheet(sheet_name).get_all_values()
+            self._build_index(sheet_name, values)
+        return values
+
+    def get_rows(self, sheet_name, start):
+        """見出しを除いた start 行目（0始まり）から最後までを読む。列は既知の幅より1列多く読む"""
+        with self.lock:
+            worksheet = self._worksheet(sheet_name)
+            idx = self._get_index(worksheet, sheet_name)
+            last = gspread.utils.rowcol_to_a1(1, max(len(idx["cols"]), idx["width"]) + 1).rstrip("0123456789")
+            values = worksheet.get(f"A{start + 2}:{last}")
+            # 読み足した行もインデックスへ（ずれていても更新・削除の前の確認で作り直される）
+            key_col = ROW_KEYS.get(sheet_name)
+            if key_col in idx["cols"]:
+                k = idx["cols"].index(key_col)
+                for i, r in enumerate(values):
+                    if len(r) > k:
+                        self._add_row(idx, r[k], start + 2 + i)
+            idx["n"] = max(idx["n"], start + 1 + len(values))
+        return values
+
+    def set_values(self, sheet_name, values):
+        with self.lock:
+            worksheet = self._worksheet(sheet_name, create=True)
+            worksheet.clear()
+            self._fit_grid(worksheet, values)
+            worksheet.update(values)
+            self._build_index(sheet_name, values)
+
+    def get_many(self, sheet_names):
+        """複数シートを values_batch_get 1回で読む（存在しないシートは空）"""
+        with self.lock:
+            try:
+                res = self.book.values_batch_get([gspread.utils.absolute_range_name(n) for n in sheet_names])
+                out = {n: pad_values(vr.get("values", [])) for n, vr in zip(sheet_names, res.get("valueRanges", []))}
+            except (gspread.exceptions.APIError, gspread.exceptions.WorksheetNotFound):
+                # 1つでも存在しないシートがあると batchGet 全体が失敗するので1枚ずつ読み直す
+                out = {}
+                for n in sheet_names:
+                    try:
+                        out[n] = self._worksheet(n).get_all_values()
+                    except gspread.exceptions.WorksheetNotFound:
+                        out[n] = []
+            for n, values in out.items():
+                self._build_index(n, values)
+        return out
+
+    def set_many(self, values_by_sheet):
+        """複数シートを values_batch_update 1回で書き換える
+
+        前回読んだときより小さくなる分は空白で上書きするので、clear は不要です
+        （このプロセスでまだ読んでいないシートだけ values_batch_clear でまとめて消します）。
+        """
+        with self.lock:
+            data, clear = [], []
+            for name, values in values_by_sheet.items():
+                self._fit_grid(self._worksheet(name, create=True), values)
+                old = self._index.get(name)
+                if old is None:
+                    clear.append(gspread.utils.absolute_range_name(name))
+                    old = {"n": 0, "width": 0}
+                data.append({
+                    "range": gspread.utils.absolute_range_name(name, "A1"),
+                    "values": pad_values(values, old["n"], old["width"]),
+                })
+            if clear:
+                self.book.values_batch_clear(body={"ranges": clear})
+            if data:
+                self.book.values_batch_update(body={"valueInputOption": "RAW", "data": data})
+            for name, values in values_by_sheet.items():
+                self._build_index(name, values)
+
+    def append_records(self, sheet_name, records):
+        if not records:
+            return
+        with self.lock:
+            try:
+                worksheet = self._worksheet(sheet_name)
+                idx = self._get_index(worksheet, sheet_name)
+            except gspread.exceptions.WorksheetNotFound:
+                idx = {"cols": []}
+            if not idx["cols"]:
+                cols = list(records[0].keys())
+                self.set_values(sheet_name, [cols] + [[str(r.get(c, "")) for c in cols] for r in records])
+                return
+            rows = [[str(r.get(c, "")) for c in idx["cols"]] for r in records]
+            res = worksheet.append_rows(rows, value_input_option="RAW")
+            start = gspread.utils.a1_to_rowcol(res["updates"]["updatedRange"].split("!")[-1].split(":")[0])[0]
+            key_col = ROW_KEYS.get(sheet_name)
+            idx["n"] = max(idx["n"], start + len(rows) - 1)
+            if key_col in idx["cols"]:
+                k = idx["cols"].index(key_col)
+                for i, r in enumerate(rows):
+                    self._add_row(idx, r[k], start + i)
+
+    def update_records(self, sheet_name, changes):
+        """changes = {キー: {列名: 値}}。書き込みは batch_update 1回。見つかったキーの一覧を返す"""
+        with self.lock:
+            worksheet = self._worksheet(sheet_name)
+            idx, found = self._locate(worksheet, sheet_name, list(changes))
+            cols = idx["cols"]
+            data = [
+                {"range": gspread.utils.rowcol_to_a1(row, cols.index(c) + 1), "values": [[str(v)]]}
+                for key, row in found.items() for c, v in changes[key].items() if c in cols
+            ]
+            if data:
+                worksheet.batch_update(data)
+            key_col = ROW_KEYS.get(sheet_name)
+            for key, row in found.items():
+                new_key = str(changes[key].get(key_col, key))
+                if new_key != key:
+                    idx["rows"].pop(key, None)
+                    self._add_row(idx, new_key, row)
+            return list(found)
+
+    def delete_records(self, sheet_name, keys):
+        """連続した行を範囲にまとめ、batch_update 1回で下の範囲から削除します。見つかったキーの一覧を返す"""
+        with self.lock:
+            worksheet = self._worksheet(sheet_name)
+            idx, found = self._locate(worksheet, sheet_name, keys)
+            rows = sorted(set(found.values()))
+            spans = []  # [開始, 終了)（0始まり）。下の範囲から並べる
+            for r in reversed(rows):
+                if spans and spans[-1][0] == r:
+                    spans[-1][0] = r - 1
+                else:
+                    spans.append([r - 1, r])
+            if spans:
+                self.book.batch_update({"requests": [
+                    {"deleteDimension": {"range": {"sheetId": worksheet.id, "dimension": "ROWS", "startIndex": a, "endIndex": b}}}
+                    for a, b in spans
+                ]})
+            for key in found:
+                idx["rows"].pop(key, None)
+            idx["n"] -= len(rows)
+            for key, rs in idx["rows"].items():
+                idx["rows"][key] = [r - bisect.bisect_left(rows, r) for r in rs]
+            return list(found)
+
+class SQLiteStorage:
+    """1シート = 1テーブルとしてローカルのSQLiteに保存するバックエンド（値はすべてTEXT）"""
+
+    # 行単位の更新・削除のキーと、期限確認の絞り込みに使う列
+    INDEXES = {"expiry_records": ["id", "shop_id", "branch_id", "expiry_date"]}
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _q(name):
+        return '"' + str(name).replace('"', '""') + '"'
+
+    def get_values(self, sheet_name):
+        with self.lock:
+            if not self._columns(sheet_name):
+                raise gspread.exceptions.WorksheetNotFound(sheet_name)
+            cur = self.conn.execute(f"SELECT * FROM {self._q(sheet_name)} ORDER BY rowid")
+            rows = cur.fetchall()
+            cols = [d[0] for d in cur.description]
+        return [cols] + [["" if v is None else str(v) for v in r] for r in rows]
+
+    def get_rows(self, sheet_name, start):
+        """見出しを除いた start 行目（0始まり）から最後までを読む"""
+        with self.lock:
+            cur = self.conn.execute(f"SELECT * FROM {self._q(sheet_name)} ORDER BY rowid LIMIT -1 OFFSET ?", [start])
+            return [["" if v is None else str(v) for v in r] for r in cur.fetchall()]
+
+    def set_values(self, sheet_name, values):
+        with self.lock, self.conn:
+            self._replace(sheet_name, values)
+
+    def sheet_names(self):
+        with self.lock:
+            return [r[0] for r in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")]
+
+    def get_many(self, sheet_names):
+        out = {}
+        for n in sheet_names:
+            try:
+                out[n] = self.get_values(n)
+            except gspread.exceptions.WorksheetNotFound:
+                out[n] = []
+        return out
+
+    def set_many(self, values_by_sheet):
+        # 全シートを1トランザクションで入れ替える
+        with self.lock, self.conn:
+            for name, values in values_by_sheet.items():
+                self._replace(name, values)
+
+    def _replace(self, sheet_name, values):
+        cols = [str(c) for c in values[0]] if values else []
+        table = self._q(sheet_name)
+        self.conn.execute(f"DROP TABLE IF EXISTS {table}")
+        if not cols:
+            return
+        self.conn.execute(f"CREATE TABLE {table} ({', '.join(self._q(c) + ' TEXT' for c in cols)})")
+        self.conn.executemany(
+            f"INSERT INTO {table} VALUES ({', '.join('?' * len(cols))})",
+            [["" if v is None else str(v) for v in r] for r in values[1:]],
+        )
+        for col in self.INDEXES.get(sheet_name, []):
+            if col in cols:
+                self.conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS {self._q(f'idx_{sheet_name}_{col}')} ON {table} ({self._q(col)})"
+                )
+
+    def _columns(self, sheet_name):
+        return [r[1] for r in self.conn.execute(f"PRAGMA table_info({self._q(sheet_name)})")]
+
+    def append_records(self, sheet_name, records):
+        if not records:
+            return
+        with self.lock:
+            cols = self._columns(sheet_name)
+        if not cols:
+            cols = list(records[0].keys())
+            self.set_values(sheet_name, [cols] + [[r.get(c, "") for c in cols] for r in records])
+            return
+        with self.lock, self.conn:
+            self.conn.executemany(
+                f"INSERT INTO {self._q(sheet_name)} VALUES ({', '.join('?' * len(cols))})",
+                [[str(r.get(c, "")) for c in cols] for r in records],
+            )
+
+    # 更新・削除は1トランザクションで行い、複数の行に当たったキーがあれば DuplicateKey で取り消す
+    def update_records(self, sheet_name, changes):
+        found, dups = [], []
+        with self.lock, self.conn:
+            cols = self._columns(sheet_name)
+            for key, row_changes in changes.items():
+                row_changes = {c: str(v) for c, v in row_changes.items() if c in cols}
+                if not row_changes:
+                    continue
+                cur = self.conn.execute(
+                    f"UPDATE {self._q(sheet_name)} SET {', '.join(self._q(c) + ' = ?' for c in row_changes)}"
+                    f" WHERE {self._q(ROW_KEYS[sheet_name])} = ?",
+                    list(row_changes.values()) + [key],
+                )
+                if cur.rowcount > 1:
+                    dups.append(key)
+                if cur.rowcount > 0:
+                    found.append(key)
+            if dups:
+                raise DuplicateKey(sheet_name, dups)
+        return found
+
+    def delete_records(self, sheet_name, keys):
+        found, dups = [], []
+        with self.lock, self.conn:
+            for key in dict.fromkeys(keys):
+                cur = self.conn.execute(
+                    f"DELETE FROM {self._q(sheet_name)} WHERE {self._q(ROW_KEYS[sheet_name])} = ?", [key]
+                )
+                if cur.rowcount > 1:
+                    dups.append(key)
+                if cur.rowcount > 0:
+                    found.append(key)
+            if dups:
+                raise DuplicateKey(sheet_name, dups)
+        return found
+
+# --- ストレージの計測 ---
+class PerfMetrics:
+    """ストレージ呼び出し・APIの呼び出し回数・画面の描画時間の記録（全セッション共通）
+
+    ストレージはシート名・操作ごとに 回数 / 所要時間 / 行数 / バイト数 / API回数 / エラー数 を合計し、
+    直近の呼び出しも keep 件まで残します。API回数は呼び出したスレッドごとに数えるので、
+    書き込みキューや同期ワーカーの呼び出しが混ざっても操作ごとの回数はずれません。
+    バイト数は sample 行を等間隔に抜き出して推定します（sample=None で全セルを数える）。
+    """
+
+    def __init__(self, keep=500, sample=100):
+        self.sample = sample
+        self.lock = threading.Lock()
+        self._local = threading.local()
+        self.recent = deque(maxlen=keep)
+        self.storage = {}
+        self.renders = {}
+        self.api_calls = 0
+
+    def count_api(self):
+        self._local.api = getattr(self._local, "api", 0) + 1
+        with self.lock:
+            self.api_calls += 1
+
+    def measure(self, op, fn, args, kwargs):
+        target = args[0] if args else ""
+        sheet = ",".join(target) if isinstance(target, (list, dict)) else str(target)
+        api = getattr(self._local, "api", 0)
+        t = time.perf_counter()
+        result, error = None, ""
+        try:
+            result = fn(*args, **kwargs)
+            return result
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            ms = (time.perf_counter() - t) * 1000
+            rows, nbytes = self._size(op, args, result)
+            entry = {
+                "at": datetime.now().strftime("%H:%M:%S"), "sheet": sheet, "op": op, "rows": rows, "bytes": nbytes,
+                "ms": round(ms, 1), "api": getattr(self._local, "api", 0) - api, "error": error,
+            }
+            with self.lock:
+                self.recent.append(entry)
+                tot = self.storage.setdefault((sheet, op), dict.fromkeys(["calls", "ms", "rows", "bytes", "api", "errors"], 0))
+                tot["calls"] += 1
+                tot["ms"] += ms
+                tot["rows"] += rows
+                tot["bytes"] += nbytes
+                tot["api"] += entry["api"]
+                tot["errors"] += bool(error)
+
+    def _cells_size(self, rows, to_row=list):
+        """行の一覧の (行数, UTF-8でのバイト数)。to_row で1行を値のリストにする"""
+        n = len(rows)
+        picked = [rows[i * n // self.sample] for i in range(self.sample)] if self.sample and n > self.sample else rows
+        nbytes = len("\x1e".join("\x1f".join(map(str, to_row(r))) for r in picked).encode("utf-8"))
+        return n, nbytes * n // len(picked) if picked else 0
+
+    def _size(self, op, args, result):
+        if op in ("get_values", "get_rows") and result:
+            return self._cells_size(result)
+        if op == "get_many" and result:
+            sizes = [self._cells_size(v) for v in result.values()]
+            return sum(r for r, _ in sizes), sum(b for _, b in sizes)
+        if op == "set_values" and len(args) > 1:
+            return self._cells_size(args[1])
+        if op == "set_many" and args:
+            sizes = [self._cells_size(v) for v in args[0].values()]
+            return sum(r for r, _ in sizes), sum(b for _, b in sizes)
+        if op in ("append_records", "update_records") and len(args) > 1:
+            rows = list(args[1].values()) if isinstance(args[1], dict) else args[1]
+            return self._cells_size(rows, lambda r: r.values())
+        if op == "delete_records" and len(args) > 1:
+            return len(args[1]), 0
+        return (len(result), 0) if isinstance(result, list) else (0, 0)
+
+    def totals(self):
+        """全体の合計（画面ごと・ベンチマークの操作ごとの差分を取るのに使う）"""
+        with self.lock:
+            return {
+                "calls": sum(t["calls"] for t in self.storage.values()),
+                "ms": round(sum(t["ms"] for t in self.storage.values()), 1),
+                "api": self.api_calls,
+            }
+
+    def record_render(self, menu, started, before):
+        """1回の描画の時間と、その間のストレージ呼び出し（他スレッドの分も含む）を記録して返す"""
+        after = self.totals()
+        entry = {
+            "at": datetime.now().strftime("%H:%M:%S"), "menu": menu,
+            "ms": round((time.perf_counter() - started) * 1000, 1),
+            "storage_calls": after["calls"] - before["calls"], "storage_ms": round(after["ms"] - before["ms"], 1),
+            "api": after["api"] - before["api"], "totals": after,
+        }
+        with self.lock:
+            tot = self.renders.setdefault(menu, {"count": 0, "ms": 0.0, "max_ms": 0.0, "last_ms": 0.0})
+            tot["count"] += 1
+            tot["ms"] += entry["ms"]
+            tot["max_ms"] = max(tot["max_ms"], entry["ms"])
+            tot["last_ms"] = entry["ms"]
+        return entry
+
+    def storage_frame(self):
+        with self.lock:
+            rows = [{"sheet": s, "op": o, **t} for (s, o), t in self.storage.items()]
+        df = pd.DataFrame(rows, columns=["sheet", "op", "calls", "ms", "rows", "bytes", "api", "errors"])
+        return df.assign(ms=df["ms"].round(1)).sort_values("ms", ascending=False)
+
+    def snapshot(self):
+        """JSONで書き出す内容"""
+        with self.lock:
+            return {
+                "totals": {"api": self.api_calls},
+                "storage": [{"sheet": s, "op": o, **t} for (s, o), t in self.storage.items()],
+                "renders": {m: dict(t, avg_ms=round(t["ms"] / t["count"], 1)) for m, t in self.renders.items()},
+                "recent": list(self.recent),
+            }
+
+@st.cache_resource
+def get_perf_metrics():
+    # 計測パネルを出すときだけバイト数を正確に数える（10万行の読み込みで数百msかかるため）
+    return PerfMetrics(sample=None if dict(st.secrets.get("debug", {})).get("panel") else 100)
+
+perf_metrics = get_perf_metrics()
+
+class _CountedApi:
+    """gspread（または MemorySpreadsheet）のオブジェクトを包み、メソッド呼び出し＝API呼び出しを数える"""
+
+    def __init__(self, obj, metrics):
+        self._obj = obj
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+        def call(*args, **kwargs):
+            self._metrics.count_api()
+            result = attr(*args, **kwargs)
+            # 取り出したワークシートへの呼び出しも数える
+            if hasattr(result, "get_all_values"):
+                return _CountedApi(result, self._metrics)
+            if isinstance(result, list) and result and hasattr(result[0], "get_all_values"):
+                return [_CountedApi(ws, self._metrics) for ws in result]
+            return result
+        return call
+
+class MeteredStorage:
+    """ストレージバックエンドを包み、OPS の呼び出しを perf_metrics に記録する"""
+
+    OPS = {
+        "get_values", "get_many", "get_rows", "set_values", "set_many",
+        "append_records", "update_records", "delete_records", "sheet_names",
+    }
+
+    def __init__(self, inner, metrics):
+        self.inner = inner
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        attr = getattr(self.inner, name)
+        if name not in self.OPS:
+            return attr
+        def call(*args, **kwargs):
+            return self.metrics.measure(name, attr, args, kwargs)
+        return call
+
+@st.cache_resource
+def get_storage():
+    conf = dict(st.secrets.get("storage", {}))
+    backend = conf.get("backend", "gspread")
+    if backend == "sqlite":
+        return MeteredStorage(SQLiteStorage(conf.get("sqlite_path", "kigen.db")), perf_metrics)
+    if backend == "memory":
+        seed = None
+        if conf.get("seed_path"):
+            with open(conf["seed_path"], encoding="utf-8") as f:
+                seed = json.load(f)
+        book = MemorySpreadsheet(seed)
+    else:
+        book = get_gspread_client().open_by_key(spreadsheet_id)
+    return MeteredStorage(SheetsStorage(_CountedApi(book, perf_metrics)), perf_metrics)
+
+storage = get_storage()
+
+# --- 1-2. 読み込みキャッシュ ---
+# 全セッション共通のキャッシュ。secrets.toml の [cache] で調整できます
+#   [cache]
+#   ttl = 60             # expiry_records / user_master の保持秒数
+#   master_ttl = 3600    # MASTER_SHEETS の保持秒数
+#   max_cells = 2000000  # キャッシュ全体で保持するセル数の上限（超えたら古いものから破棄）
+#   full_ttl = 3600      # DELTA_SHEETS を全件読み直す間隔（それまでは増えた行だけを読み足す）
+MASTER_SHEETS = ["item_master", "branch_master", "shop_master"]
+# 行が増える一方のシート。TTLが切れたら前回の最終行より後ろだけを読む
+DELTA_SHEETS = ["expiry_records"]
+# 期限切れの記録を移すアーカイブシート（期限の年ごと。例: expiry_archive_2025）
+ARCHIVE_PREFIX = "expiry_archive_"
+
+class SheetCache:
+    """シート名 → DataFrame のTTL付きキャッシュ
+
+    書き込みのたびにシートごとのバージョンを進めます。読み込み開始時のバージョンと
+    put 時のバージョンが違えば（読んでいる間に書き込みがあれば）古いデータは保存しません。
+    このアプリからの行単位の書き込みは、読み直さずに patch でキャッシュ中の表へ反映します。
+    行単位の書き込みでは、ストレージへ書く前（begin_write）と反映後（patch）の2回バージョンを進めます。
+    書き込みの途中で読んだ表（新しい行を含むかもしれない）が保存されて、patch で同じ行が
+    二重に足されることはありません。
+    """
+
+    def __init__(self, ttl=60, master_ttl=3600, max_cells=2_000_000, full_ttl=3600):
+        self.ttl = ttl
+        self.master_ttl = master_ttl
+        self.max_cells = max_cells
+        self.full_ttl = full_ttl
+        self.lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._versions = {}
+        self.hits = 0
+        self.misses = 0
+
+    def ttl_for(self, sheet_name):
+        # アーカイブは移すとき以外に書き換わらないので、マスタと同じく長く持つ
+        if sheet_name in MASTER_SHEETS or sheet_name.startswith(ARCHIVE_PREFIX):
+            return self.master_ttl
+        return self.ttl
+
+    def version(self, sheet_name):
+        with self.lock:
+            return self._versions.get(sheet_name, 0)
+
+    def get(self, sheet_name):
+        with self.lock:
+            entry = self._entries.get(sheet_name)
+            if entry and time.monotonic() - entry["at"] < self.ttl_for(sheet_name):
+                self._entries.move_to_end(sheet_name)
+                self.hits += 1
+                return entry["df"]
+            self.misses += 1
+            return None
+
+    def stale(self, sheet_name):
+        """TTLが切れていても残っている表を返す（full_ttl を過ぎていれば None）"""
+        with self.lock:
+            entry = self._entries.get(sheet_name)
+            if entry and time.monotonic() - entry["full_at"] < self.full_ttl:
+                return entry["df"]
+            return None
+
+    def put(self, sheet_name, df, version, full=True):
+        """full=False は前回の表に行を読み足したもの（全件読み直しの時刻は引き継ぐ）"""
+        with self.lock:
+            if version != self._versions.get(sheet_name, 0) or df.size > self.max_cells:
+                return
+            now = time.monotonic()
+            prev = self._entries.get(sheet_name)
+            full_at = prev["full_at"] if prev and not full else now
+            self._entries[sheet_name] = {"df": df, "at": now, "full_at": full_at}
+            self._entries.move_to_end(sheet_name)
+            while sum(e["df"].size for e in self._entries.values()) > self.max_cells:
+                self._entries.popitem(last=False)
+
+    def begin_write(self, sheet_name):
+        """ストレージへ書く直前に呼ぶ。バージョンを進め、(書き込み前のバージョン, その時点の表) を返す
+
+        ここより前に読み始めた load_data は put で弾かれます。表はキャッシュに残すので、
+        書き込みの間も読み込みは書き込み前の表で答えます。
+        """
+        with self.lock:
+            since = self._versions.get(sheet_name, 0)
+            self._versions[sheet_name] = since + 1
+            return since, self._entries.get(sheet_name)
+
+    def patch(self, sheet_name, fn, since, base):
+        """begin_write で受け取った書き込み前の表 base に fn(表) で書き込みを反映し、バージョンを進める
+
+        書き込み中に読んで put された表は、base から作った表で置き換えます。
+        戻り値は反映後のバージョンです。書き込みの間に invalidate など別の変更があったときは None を返し、
+        表も破棄します（索引にも差分を当てさせない）。fn が失敗したときは表だけを破棄します。
+        """
+        with self.lock:
+            version = self._versions.get(sheet_name, 0)
+            self._versions[sheet_name] = version + 1
+            if version != since + 1:
+                self._entries.pop(sheet_name, None)
+                return None
+            try:
+                df = fn(base["df"]) if base is not None else None
+            except Exception:
+                df = None
+            if df is not None and df.size <= self.max_cells:
+                self._entries[sheet_name] = dict(base, df=df)
+            else:
+                self._entries.pop(sheet_name, None)
+            return version + 1
+
+    def invalidate(self, sheet_name=None):
+        with self.lock:
+            names = [sheet_name] if sheet_name else list(set(self._entries) | set(self._versions))
+            for name in names:
+                self._entries.pop(name, None)
+                self._versions[name] = self._versions.get(name, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "sheets": list(self._entries)}
+
+@st.cache_resource
+def get_sheet_cache():
+    conf = dict(st.secrets.get("cache", {}))
+    return SheetCache(
+        ttl=float(conf.get("ttl", 60)),
+        master_ttl=float(conf.get("master_ttl", 3600)),
+        max_cells=int(conf.get("max_cells", 2_000_000)),
+        full_ttl=float(conf.get("full_ttl", 3600)),
+    )
+
+sheet_cache = get_sheet_cache()
+
+# --- 1-3. 書き込みキュー ---
+class WriteConflict(Exception):
+    """読み込んでから書き戻すまでの間に、同じシートへ別の書き込みが入ったことを表す"""
+
+class WriteQueue:
+    """すべての書き込みを1本のスレッドで順番に反映する（単一ライター）
+
+    同時に届いた書き込みは、シートごとに同じ種類（append / update / delete）が続く部分を
+    1回の書き込みにまとめます。replace（シート全体の書き換え）は読み込み時のバージョン
+    base_versions と今のバージョンが違えば WriteConflict を返し、呼び出し側に読み直させます。
+    書き込んだ内容はキャッシュ中の表にも反映し、user_master は認証インデックスにも反映します。
+    行単位の書き込みは sheet_cache.begin_write → ストレージ → sheet_cache.patch の順に行います。
+    まとめた update / delete が DuplicateKey になったときは（1行も書かれていないので）1件ずつやり直し、
+    重複したキーを送った呼び出しだけにエラーを返します。
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.stats = {"ops": 0, "batches": 0, "conflicts": 0, "errors": 0}
+        self._thread = threading.Thread(target=self._run, name="write-queue", daemon=True)
+        self._thread.start()
+
+    def submit(self, sheet_name, kind, payload, base_versions=None):
+        """書き込みを積み、反映されるまで待って結果を返す（失敗したときは例外を送出）
+
+        append: レコード(dict)の一覧 → 件数 / update: {キー: {列名: 値}} → 見つかった件数
+        delete: キーの一覧 → 見つかった件数 / replace: {シート名: 2次元リスト} → True
+        """
+        future = Future()
+        self._queue.put((sheet_name, kind, payload, base_versions or {}, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            ops = [self._queue.get()]
+            while True:
+                try:
+                    ops.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            by_sheet = {}
+            for op in ops:
+                by_sheet.setdefault(op[0], []).append(op)
+            for sheet_ops in by_sheet.values():
+                group = []
+                for op in sheet_ops:
+                    if group and (op[1] != group[0][1] or op[1] == "replace"):
+                        self._commit(group)
+                        group = []
+                    group.append(op)
+                self._commit(group)
+
+    def _commit(self, group):
+        sheet_name, kind = group[0][0], group[0][1]
+        try:
+            if kind == "replace":
+                payload, base_versions = group[0][2], group[0][3]
+                since = {n: sheet_cache.version(n) for n in payload}
+                if any(v is not None and v != since[n] for n, v in base_versions.items()):
+                    with self.lock:
+                        self.stats["conflicts"] += 1
+                    group[0][4].set_exception(WriteConflict(", ".join(payload)))
+                    return
+                storage.set_many(payload)
+                results = [True]
+            else:
+                since, base = sheet_cache.begin_write(sheet_name)
+                if kind == "append":
+                    payload = [r for op in group for r in op[2]]
+                    storage.append_records(sheet_name, payload)
+                    results = [len(op[2]) for op in group]
+                elif kind == "update":
+                    payload = {}
+                    for op in group:
+                        for key, changes in op[2].items():
+                            payload.setdefault(key, {}).update(changes)
+                    found = set(storage.update_records(sheet_name, payload))
+                    results = [sum(k in found for k in op[2]) for op in group]
+                else:
+                    payload = list(dict.fromkeys(k for op in group for k in op[2]))
+                    found = set(storage.delete_records(sheet_name, payload))
+                    results = [sum(k in found for k in set(op[2])) for op in group]
+        except Exception as e:
+            if isinstance(e, DuplicateKey) and len(group) > 1:
+                for op in group:
+                    self._commit([op])
+                return
+            for n in (group[0][2] if kind == "replace" else [sheet_name]):
+                sheet_cache.invalidate(n)
+            with self.lock:
+                self.stats["errors"] += 1
+            for op in group:
+                op[4].set_exception(e)
+            return
+
+        if kind == "replace":
+            # 書いた内容をそのままキャッシュへ（次の load_data で読み直さない）
+            for n, values in payload.items():
+                sheet_cache.invalidate(n)
+                df = apply_schema(pd.DataFrame(values[1:], columns=[str(c).strip() for c in values[0]]), n) if values else pd.DataFrame()
+                sheet_cache.put(n, df, sheet_cache.version(n))
+        else:
+            version = sheet_cache.patch(sheet_name, lambda df: _patch_frame(df, sheet_name, kind, payload), since, base)
+            try:
+                if sheet_name == "user_master" and version is not None:
+                    getattr(cred_index, f"apply_{kind}")(payload, since, version)
+            except Exception:
+                # 反映できなくても、索引はバージョンの違いから自分で作り直す
+                pass
+        with self.lock:
+            self.stats["ops"] += len(group)
+            self.stats["batches"] += 1
+        for op, result in zip(group, results):
+            op[4].set_result(result)
+
+@st.cache_resource
+def get_write_queue():
+    return WriteQueue()
+
+write_queue = get_write_queue()
+
+# --- 2. データ操作基本関数 ---
+# シートごとの列の型。str: 文字列 / category: 値の種類が少ない列 / date: 日付（YYYY-MM-DD）
+# ここにない列は文字列のまま読み込みます。解釈できない日付は空欄（NaT）になります
+SCHEMAS = {
+    "expiry_records": {
+        "id": "str", "shop_id": "category", "branch_id": "category", "category": "category",
+        "item_name": "str", "expiry_date": "date", "input_date": "date",
+    },
+    "item_master": {"item_id": "str", "category": "category", "item_name": "str", "input_type": "category"},
+    "shop_master": {"shop_id": "str", "branch_id": "category", "shop_name": "str"},
+    "branch_master": {"branch_id": "str", "branch_name": "str"},
+    "user_master": {"id": "str", "password": "str", "role": "category", "target_id": "str", "name": "str"},
+}
+
+def apply_schema(df, sheet_name):
+    """SCHEMAS の型に列をそろえる（列ごとにまとめて変換し、行単位の処理はしない）"""
+    if sheet_name.startswith(ARCHIVE_PREFIX):
+        sheet_name = "expiry_records"
+    schema = SCHEMAS.get(sheet_name, {})
+    types = {c: t for c, t in schema.items() if c in df.columns and t != "date"}
+    if types:
+        df = df.astype(types)
+    for c, t in schema.items():
+        if c in df.columns and t == "date":
+            df[c] = pd.to_datetime(df[c], format="ISO8601", errors="coerce")
+    return df
+
+def as_text(df):
+    """シートに書くための文字列の表にする（日付は YYYY-MM-DD、空欄は ""）"""
+    out = df.copy()
+    for c in out.columns[[pd.api.types.is_datetime64_any_dtype(t) for t in out.dtypes]]:
+        out[c] = out[c].dt.strftime("%Y-%m-%d")
+    return out.astype(object).fillna("").astype(str)
+
+def concat_typed(frames, sheet_name):
+    """型をそろえたまま行を連結する（カテゴリ列はカテゴリを合わせてから連結し、文字列に戻さない）"""
+    frames = [apply_schema(f, sheet_name) for f in frames]
+    for c in frames[0].columns:
+        if all(isinstance(f[c].dtype, pd.CategoricalDtype) for f in frames):
+            cats = sorted(set().union(*(f[c].cat.categories for f in frames)))
+            for f in frames:
+                f[c] = f[c].cat.set_categories(cats)
+    return pd.concat(frames)
+
+def _patch_frame(df, sheet_name, kind, payload):
+    """書き込みキューで行った append / update / delete を、読み込み済みの表に反映した表を返す
+
+    ストレージと同じく、複数の行に当たるキーがあれば DuplicateKey（キャッシュの表は破棄される）。
+    """
+    key = ROW_KEYS[sheet_name]
+    if key not in df.columns:
+        raise KeyError(key)
+    if kind != "append":
+        hit = df[key][df[key].isin(list(payload))]
+        if hit.duplicated().any():
+            raise DuplicateKey(sheet_name, hit[hit.duplicated()].unique().tolist())
+    if kind == "delete":
+        out = df[~df[key].isin(payload)].reset_index(drop=True)
+        for c in out.columns[[isinstance(t, pd.CategoricalDtype) for t in out.dtypes]]:
+            out[c] = out[c].cat.remove_unused_categories()
+        return out
+    if kind == "append":
+        new = pd.DataFrame([[str(r.get(c, "")) for c in df.columns] for r in payload], columns=df.columns)
+        return concat_typed([df, new], sheet_name).reset_index(drop=True)
+    hit = df[key].isin(list(payload))
+    rows = as_text(df[hit])
+    for i, k in list(rows[key].items()):
+        for c, v in payload[k].items():
+            if c in rows.columns:
+                rows.at[i, c] = str(v)
+    return concat_typed([df[~hit], rows], sheet_name).sort_index()
+
+def _read_delta(sheet_name):
+    """TTLの切れた表に、前回の最終行より後ろの行だけを読み足して返す（全件読むべきときは None）"""
+    base = sheet_cache.stale(sheet_name)
+    key = ROW_KEYS[sheet_name]
+    if base is None or base.empty or key not in base.columns:
+        return None
+    # 前回の最終行から読み、同じ位置に同じキーがあるか確かめる（途中の行が消えていたら全件読み直し）
+    try:
+        rows = pad_values(storage.get_rows(sheet_name, len(base) - 1), cols=len(base.columns))
+    except Exception:
+        return None
+    if not rows or len(rows[0]) != len(base.columns) or rows[0][base.columns.get_loc(key)] != base[key].iat[-1]:
+        return None
+    if len(rows) == 1:
+        return base
+    new = pd.DataFrame(rows[1:], columns=base.columns)
+    return concat_typed([base, new], sheet_name).reset_index(drop=True)
+
+def _read_frame(sheet_name, copy=True):
+    """copy=False はキャッシュ中の表をそのまま返す（読むだけの呼び出し側用）"""
+    cached = sheet_cache.get(sheet_name)
+    if cached is not None:
+        return cached.copy() if copy else cached
+    version = sheet_cache.version(sheet_name)
+    df = _read_delta(sheet_name) if sheet_name in DELTA_SHEETS else None
+    if df is not None:
+        sheet_cache.put(sheet_name, df, version, full=False)
+        return df.copy() if copy else df
+    data = storage.get_values(sheet_name)
+    if len(data) > 0:
+        cols = [c.strip() for c in data[0]]
+        df = apply_schema(pd.DataFrame(data[1:], columns=cols), sheet_name)
+    else:
+        df = pd.DataFrame()
+    sheet_cache.put(sheet_name, df, version)
+    return df.copy() if copy else df
+
+# load_data はキャッシュのコピーを返すので、呼び出し側で自由に書き換えてかまいません
+def load_data(sheet_name):
+    try:
+        return _read_frame(sheet_name)
+    except Exception:
+        # 失敗はストレージの計測（perf_metrics）にエラーとして残る
+        return pd.DataFrame()
+
+def _shared_frame(sheet_name):
+    """load_data と同じ表をコピーせずに返す（索引・集計用。書き換えてはいけない）
+
+    キャッシュ中の表は書き込みのたびに新しい表へ差し替わるので、同じ表かどうかは is で比べられます。
+    """
+    try:
+        return _read_frame(sheet_name, copy=False)
+    except Exception:
+        return pd.DataFrame()
+
+def _to_values(df):
+    df_save = as_text(df)
+    return [df_save.columns.tolist()] + df_save.values.tolist()
+
+# 書き込みはすべて write_queue を通します
+def save_data(df, sheet_name, base_version=None):
+    """シート全体を書き換える。base_version を渡すと、その後に別の書き込みがあれば WriteConflict"""
+    try:
+        write_queue.submit(sheet_name, "replace", {sheet_name: _to_values(df)}, {sheet_name: base_version})
+        return True
+    except WriteConflict:
+        raise
+    except Exception as e:
+        st.error(f"保存エラー: {e}")
+        return False
+
+def modify_data(sheet_name, fn, retries=3):
+    """読み込み → fn(df) → 書き戻し。途中で別の書き込みが入っていたら読み直してやり直す"""
+    for _ in range(retries):
+        version = sheet_cache.version(sheet_name)
+        try:
+            df = _read_frame(sheet_name)
+        except gspread.exceptions.WorksheetNotFound:
+            df = pd.DataFrame()
+        except Exception as e:
+            # 読めなかったまま書き戻すとシートを消してしまうので、ここでやめる
+            st.error(f"読み込みエラー: {e}")
+            return False
+        try:
+            return save_data(fn(df), sheet_name, base_version=version)
+        except WriteConflict:
+            continue
+    st.error("他の端末の保存と重なったため保存できませんでした。もう一度お試しください")
+    return False
+
+# 行単位の書き込み（シート全体は書き直さない）。行の特定には ROW_KEYS のキー列を使います
+def append_data(df, sheet_name):
+    try:
+        write_queue.submit(sheet_name, "append", as_text(df).to_dict("records"))
+        return True
+    except Exception as e:
+        st.error(f"保存エラー: {e}")
+        return False
+
+def update_data(sheet_name, changes):
+    """changes = {キー: {列名: 値}} をまとめて書き込み、更新できた件数を返す"""
+    try:
+        count = write_queue.submit(sheet_name, "update", changes)
+        if count < len(changes):
+            st.error("一部のデータが見つかりません（他の端末で削除された可能性があります）")
+        return count
+    except Exception as e:
+        st.error(f"保存エラー: {e}")
+        return 0
+
+def delete_data(sheet_name, keys):
+    """キーの一覧をまとめて削除し、削除できた件数を返す"""
+    try:
+        count = write_queue.submit(sheet_name, "delete", keys)
+        if count < len(set(keys)):
+            st.error("一部のデータが見つかりません（他の端末で削除された可能性があります）")
+        return count
+    except Exception as e:
+        st.error(f"保存エラー: {e}")
+        return 0
+
+def sheets_using_id(new_id, sheet_names):
+    """new_id をすでにキー列（ROW_KEYS）に持つシート名の一覧を返す（登録・ID変更の前の確認用）"""
+    used = []
+    for name in sheet_names:
+        df = _shared_frame(name)
+        col = ROW_KEYS[name]
+        if col in df and (df[col].astype(str) == str(new_id)).any():
+            used.append(name)
+    return used
+
+class RecordIdGenerator:
+    """ULID 形式（26文字）のレコードIDを発行する
+
+    先頭10文字がミリ秒の時刻、残り16文字が乱数で、文字列の順に並べると発行順になります。
+    同じミリ秒の中では乱数部分を1ずつ増やすので、同じプロセス内では重複しません。
+    """
+
+    ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"  # Crockford Base32
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._last_ms = 0
+        self._last_rand = 0
+
+    def _encode(self, value, length):
+        return "".join(self.ALPHABET[(value >> (5 * i)) & 31] for i in reversed(range(length)))
+
+    def new(self, n=1):
+        """ID を n 個まとめて返す"""
+        ids = []
+        with self.lock:
+            for _ in range(n):
+                ms = time.time_ns() // 1_000_000
+                if ms <= self._last_ms:
+                    ms, rand = self._last_ms, self._last_rand + 1
+                else:
+                    rand = int.from_bytes(os.urandom(10), "big") >> 1  # 繰り上がりの余地を残す
+                self._last_ms, self._last_rand = ms, rand
+                ids.append(self._encode(ms, 10) + self._encode(rand, 16))
+        return ids
+
+@st.cache_resource
+def get_record_ids():
+    return RecordIdGenerator()
+
+record_ids = get_record_ids()
+
+def with_new_items(new):
+    """new（category / item_name / input_type）に続き番号の item_id を付けて足す、modify_data 用の関数を返す"""
+    def add_items(df):
+        ids = pd.to_numeric(df["item_id"], errors="coerce") if "item_id" in df else pd.Series(dtype=float)
+        start = int(ids.max()) + 1 if ids.notna().any() else 1
+        return pd.concat([df, pd.DataFrame({
+            "item_id": [str(i) for i in range(start, start + len(new))],
+            "category": new["category"].to_numpy(),
+            "item_name": new["item_name"].to_numpy(),
+            "input_type": new["input_type"].to_numpy(),
+        })])
+    return add_items
+
+def renumber_duplicate_items(df):
+    """item_id が重複している行の2つ目以降に、続き番号の新しい item_id を振る（modify_data 用）
+
+    行単位の更新・削除は重複したキーを拒否するので、重複が残っている item_master はこれで直します。
+    """
+    dup = df["item_id"].duplicated()
+    if not dup.any():
+        return df
+    ids = pd.to_numeric(df["item_id"], errors="coerce")
+    start = int(ids.max()) + 1 if ids.notna().any() else 1
+    df = df.copy()
+    df.loc[dup, "item_id"] = [str(i) for i in range(start, start + int(dup.sum()))]
+    return df
+
+def expiry_records_for(shop_name, rows):
+    """rows（category / item_name / expiry_date）に id・店舗・支部・登録日を付けた、expiry_records に追加する表"""
+    s_m = load_data("shop_master")
+    b_ids = s_m.loc[s_m["shop_name"] == shop_name, "branch_id"] if not s_m.empty else []
+    return pd.DataFrame({
+        "id": record_ids.new(len(rows)),
+        "shop_id": shop_name,
+        "branch_id": b_ids.iloc[0] if len(b_ids) else "",
+        "category": rows["category"].astype(str).to_numpy(),
+        "item_name": rows["item_name"].astype(str).to_numpy(),
+        "expiry_date": pd.to_datetime(rows["expiry_date"]).dt.strftime("%Y-%m-%d").to_numpy(),
+        "input_date": str(date.today()),
+    })
+
+def validate_dates(values, fmts):
+    """期限の入力を列ごとにまとめて検証する。(日付の Series, エラー文の Series) を返す
+
+    年月日は8桁、年月のみは6桁の数字（年月のみは月末日とする）で、存在しない日付と過去の日付は不可。
+    values は入力文字列、fmts は行ごとの形式（年月日 / 年月のみ）。区切りの - / . と、
+    Excelの日付セルを読んだときに付く時刻は取り除いてから判定します。エラーのない行は空文字。
+    """
+    s = values.fillna("").astype(str).str.strip().str.replace(r"\s+00:00:00$", "", regex=True)
+    s = s.str.replace(r"[-/.]", "", regex=True)
+    ymd = fmts.eq("年月日")
+    err = pd.Series("", index=s.index)
+    err = err.mask(ymd & ~s.str.fullmatch(r"\d{8}"), "8桁の数字で入力してください")
+    err = err.mask(~ymd & ~s.str.fullmatch(r"\d{6}"), "6桁の数字で入力してください")
+    month = pd.to_numeric(s.str[4:6], errors="coerce")
+    err = err.mask(err.eq("") & ~ymd & ~month.between(1, 12), "月が不正です")
+    # 年月のみは月末日にする
+    dt = pd.to_datetime(s.where(ymd, s.str[:6] + "01"), format="%Y%m%d", errors="coerce")
+    dt = dt.where(ymd, dt + pd.offsets.MonthEnd(0))
+    err = err.mask(err.eq("") & (dt.isna() | s.str[:4].eq("0000")), "正しい日付を入力してください")
+    err = err.mask(err.eq("") & (dt < pd.Timestamp(date.today())), "過去の日付は登録できません")
+    return dt.where(err.eq("")), err
+
+ITEM_CATEGORIES = ["冷蔵食材", "冷凍食材", "常温食材", "ドリンク", "ピックアップ"]
+INPUT_TYPES = ["年月日", "年月のみ"]
+
+# 取り込みファイルの見出し（日本語の見出しも使えます）
+UPLOAD_ALIASES = {"商品ID": "item_id", "商品名": "item_name", "期限": "expiry_date", "カテゴリ": "category", "形式": "input_type"}
+
+def read_upload(file):
+    """アップロードされた CSV / XLSX を、すべて文字列の DataFrame として読む（見出しは UPLOAD_ALIASES で英名へ）"""
+    if file.name.lower().endswith((".xlsx", ".xlsm")):
+        df = pd.read_excel(file, dtype=str).fillna("")
+    else:
+        raw = file.getvalue()
+        try:
+            text = raw.decode("utf-8-sig")
+        except UnicodeDecodeError:
+            text = raw.decode("cp932")  # Excelで保存した日本語のCSV
+        df = pd.read_csv(io.StringIO(text), dtype=str, keep_default_na=False)
+    df.columns = [UPLOAD_ALIASES.get(str(c).strip(), str(c).strip()) for c in df.columns]
+    return df
+
+def convert_df(df):
+    return df.to_csv(index=False).encode('utf_8_sig')
+
+# --- エクセルレポート（xlsxwriter） ---
+REPORT_COLUMNS = [
+    ("shop_id", "店舗"), ("branch_id", "支部ID"), ("category", "カテゴリ"),
+    ("item_name", "商品名"), ("expiry_date", "期限"), ("input_date", "登録日"),
+]
+# constant_memory モードはシートごとに一時ファイルを開くため、シート数に上限を設ける
+REPORT_MAX_SHEETS = 250
+
+def _sheet_title(name, used):
+    base = re.sub(r"[\[\]:*?/\\]", "_", str(name)).strip("'") or "未設定"
+    title, n = base[:31], 2
+    while title.lower() in used:
+        title = f"{base[:27]}({n})"
+        n += 1
+    used.add(title.lower())
+    return title
+
+def build_xlsx_report(df, group_by):
+    """期限データを group_by（shop_id / category）ごとのシートに分けたXLSXのバイト列を返す
+
+    constant_memory モードで1行ずつ書き出すので、件数が増えてもメモリはほぼ一定です。
+    並び替えは1回だけ行い、グループの境目の位置でシートを切り替えます。
+    グループの列はシート名と同じなので各シートには書きません。
+    """
+    cols = [c for c, _ in REPORT_COLUMNS if c in df.columns and c != group_by]
+    headers = [dict(REPORT_COLUMNS)[c] for c in cols]
+    data = df.sort_values([group_by, "expiry_date"], kind="stable")
+    exp = data["expiry_date"]
+    today = pd.Timestamp(date.today())
+
+    # 日付はExcelのシリアル値で書き、列の書式で日付表示する（空の日付は空欄）
+    date_cols = [c for c in ("expiry_date", "input_date") if c in cols]
+    values = pd.DataFrame({
+        c: (data[c] - pd.Timestamp("1899-12-30")).dt.days.astype(object).where(data[c].notna(), "")
+        if c in date_cols else data[c].astype(object).fillna("")
+        for c in cols
+    })
+    keys = data[group_by]
+    starts = keys.ne(keys.shift()).to_numpy().nonzero()[0].tolist()
+    bounds = starts + [len(data)]
+
+    output = io.BytesIO()
+    wb = xlsxwriter.Workbook(output, {"constant_memory": True})
+    head_fmt = wb.add_format({"bold": True, "bg_color": "#DDEBF7", "border": 1})
+    date_fmt = wb.add_format({"num_format": "yyyy-mm-dd"})
+    levels = [  # 上にあるものほど優先
+        ("<TODAY()", wb.add_format({"bg_color": "#FFC7CE", "font_color": "#9C0006"})),
+        ("<=TODAY()+7", wb.add_format({"bg_color": "#FFD8A8"})),
+        ("<=TODAY()+30", wb.add_format({"bg_color": "#FFEB9C"})),
+    ]
+    used = set()
+
+    # 1枚目：グループごとの件数
+    summary = wb.add_worksheet(_sheet_title("集計", used))
+    summary.set_column(0, 2, 16)
+    summary.write_row(0, 0, [dict(REPORT_COLUMNS)[group_by], "件数", "期限切れ"], head_fmt)
+    expired = (exp < today).groupby(keys, sort=False, observed=True).sum()
+    for r, (s, e) in enumerate(zip(bounds, bounds[1:]), start=1):
+        summary.write_row(r, 0, [keys.iat[s], e - s, int(expired[keys.iat[s]])])
+
+    rows = values.itertuples(index=False, name=None)
+    d = xl_col_to_name(cols.index("expiry_date"))
+    last = xl_col_to_name(len(cols) - 1)
+    for s, e in zip(bounds, bounds[1:]):
+        ws = wb.add_worksheet(_sheet_title(keys.iat[s], used))
+        ws.set_column(0, len(cols) - 1, 14)
+        for c in date_cols:
+            ws.set_column(cols.index(c), cols.index(c), 12, date_fmt)
+        ws.freeze_panes(1, 0)
+        ws.write_row(0, 0, headers, head_fmt)
+        for r in range(1, e - s + 1):
+            ws.write_row(r, 0, next(rows))
+        ws.autofilter(0, 0, e - s, len(cols) - 1)
+        for cond, fmt in levels:
+            ws.conditional_format(f"A2:{last}{e - s + 1}", {
+                "type": "formula", "criteria": f"=AND(ISNUMBER(${d}2),${d}2{cond})", "format": fmt,
+            })
+    wb.close()
+    return output.getvalue()
+
+# --- 期限切れ記録のアーカイブ ---
+# 期限から days 日以上たった記録を expiry_records からアーカイブシートへ移します
+#   [archive]
+#   days = 90  # 0 で無効
+class RetentionJob:
+    """期限切れの記録を、期限の年ごとのアーカイブシート（ARCHIVE_PREFIX + 年）へ移す
+
+    同期ワーカー（ワーカーを止めているときは「更新」ボタン）から1日1回 run_if_due で呼ばれます。
+    追加 → 削除の順に書き込み、途中で失敗してもアーカイブにすでにある id は追加しないので、
+    次回そのまま続きから移せます。アーカイブを読めなかった年は（重複して追加しないように）飛ばし、
+    すべて移せるまで run_if_due のたびにやり直します。
+    実行は同時に1つだけです（2つが同じアーカイブを読んでから追加すると、同じ記録が2回入るため）。
+    """
+
+    def __init__(self, days):
+        self.days = days
+        self.lock = threading.Lock()
+        self._running = threading.Lock()
+        self.last_run = None
+        self._status = {"at": None, "msg": "", "moved": {}}
+
+    def status(self):
+        with self.lock:
+            return dict(self._status)
+
+    def running(self):
+        return self._running.locked()
+
+    def run_if_due(self):
+        if self.days > 0 and self.last_run != date.today():
+            self.run()
+
+    def run(self):
+        """移した件数を {アーカイブシート名: 件数} で返す。ほかの実行の途中なら待たずに None を返す"""
+        if not self._running.acquire(blocking=False):
+            return None
+        try:
+            return self._move()
+        finally:
+            self._running.release()
+
+    def _move(self):
+        moved, skipped = {}, []
+        try:
+            hot = _read_frame("expiry_records")
+            if not hot.empty:
+                cutoff = pd.Timestamp(date.today() - timedelta(days=self.days))
+                old = hot[hot["expiry_date"] < cutoff]
+                for year, part in old.groupby(old["expiry_date"].dt.year):
+                    name = f"{ARCHIVE_PREFIX}{year}"
+                    try:
+                        archived = _read_frame(name)
+                    except gspread.exceptions.WorksheetNotFound:
+                        archived = pd.DataFrame()
+                    except Exception as e:
+                        skipped.append(f"{year}年（{e}）")
+                        continue
+                    new = part[~part["id"].isin(archived["id"])] if "id" in archived else part
+                    if not new.empty:
+                        write_queue.submit(name, "append", as_text(new).to_dict("records"))
+                    write_queue.submit("expiry_records", "delete", part["id"].tolist())
+                    moved[name] = len(part)
+            msg = f"アーカイブ: {sum(moved.values())} 件を移しました（期限から{self.days}日以上）"
+            if skipped:
+                msg += f"。読み込めなかったため次回に回しました: {'、'.join(skipped)}"
+            done = not skipped
+        except Exception as e:
+            msg = f"アーカイブエラー: {e}"
+            done = False
+        with self.lock:
+            if done:
+                self.last_run = date.today()
+            self._status = {"at": datetime.now(), "msg": msg, "moved": moved}
+        return moved
+
+@st.cache_resource
+def get_retention_job():
+    return RetentionJob(int(dict(st.secrets.get("archive", {})).get("days", 90)))
+
+retention_job = get_retention_job()
+
+def archive_years():
+    """アーカイブのある年の一覧（新しい年から）"""
+    try:
+        names = storage.sheet_names()
+    except Exception:
+        return []
+    return sorted((n[len(ARCHIVE_PREFIX):] for n in names if n.startswith(ARCHIVE_PREFIX)), reverse=True)
+
+def load_archive(shops=None, years=None):
+    """アーカイブの記録を読む。shops で店舗、years で年を絞る（None はすべて）"""
+    frames = [load_data(f"{ARCHIVE_PREFIX}{y}") for y in (archive_years() if years is None else years)]
+    frames = [f for f in frames if not f.empty]
+    if not frames:
+        return pd.DataFrame()
+    df = concat_typed(frames, "expiry_records").reset_index(drop=True)
+    return df if shops is None else df[df["shop_id"].isin(shops)]
+
+# --- ★追加：DB用スプレッドシートから同期する関数 ---
+# 同期対象（必要に応じて増減OK）
+SYNC_TARGETS = ["user_master", "branch_master", "shop_master", "item_master"]
+
+@st.cache_resource
+def get_db_sheet(db_id):
+    conf = dict(st.secrets.get("storage", {}))
+    if conf.get("backend") == "memory":
+        # ローカル検証用：DBシートも db_seed_path のJSONから作るインメモリ版
+        seed = None
+        if conf.get("db_seed_path"):
+            with open(conf["db_seed_path"], encoding="utf-8") as f:
+                seed = json.load(f)
+        return _CountedApi(MemorySpreadsheet(seed), perf_metrics)
+    return _CountedApi(get_gspread_client().open_by_key(db_id), perf_metrics)
+
+def _values_hash(values):
+    # ヘッダーの前後空白と、末尾の空セル・空行の違いは無視する
+    rows = [[c.strip() for c in values[0]]] + [list(r) for r in values[1:]] if values else []
+    for r in rows:
+        while r and r[-1] == "":
+            r.pop()
+    while rows and not rows[-1]:
+        rows.pop()
+    return hashlib.sha256(json.dumps(rows, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def sync_from_database_sheet(db_id=None):
+    """
+    DB用スプレッドシートが別にある場合に、
+    DB側の指定ワークシートをこの運用スプレッドシートへ上書き同期します。
+
+    secrets.toml に以下を入れると有効化：
+      db_spreadsheet_id = "（DB用スプレッドシートID）"
+
+    未設定の場合は「同期スキップ（再読込のみ）」になります。
+
+    DB側と運用側の SYNC_TARGETS をそれぞれ values_batch_get 1回で（並行して）読み、
+    内容のハッシュが違うシートだけを values_batch_update 1回でまとめて書き込みます。
+    読み込みに失敗したときは1枚も書き込みません（マスタ同士の食い違いを防ぐ）。
+
+    バックグラウンドの SyncWorker からは db_id を引数で渡します。
+
+    戻り値: (成否, メッセージ, {シート名: {"status", "rows", "hash_ms"}})
+    読み込み・書き込みは全シートまとめて1回なので、その時間はメッセージに出します。
+    シートごとに測れるのは内容の比較（hash_ms）だけです。
+    """
+    report = {}
+    try:
+        if db_id is None:
+            db_id = st.secrets.get("db_spreadsheet_id", "")
+        if not db_id:
+            return False, "db_spreadsheet_id が未設定のため同期はスキップしました（再読込のみ）。", report
+
+        t_start = time.perf_counter()
+        db_sheet = get_db_sheet(db_id)
+        versions = {n: sheet_cache.version(n) for n in SYNC_TARGETS}
+        with ThreadPoolExecutor(max_workers=2) as ex:
+            f_src = ex.submit(db_sheet.values_batch_get, [gspread.utils.absolute_range_name(n) for n in SYNC_TARGETS])
+            f_cur = ex.submit(storage.get_many, SYNC_TARGETS)
+            src = {n: pad_values(vr.get("values", [])) for n, vr in zip(SYNC_TARGETS, f_src.result().get("valueRanges", []))}
+            current = f_cur.result()
+        read_ms = (time.perf_counter() - t_start) * 1000
+
+        changed = {}
+        for ws_name in SYNC_TARGETS:
+            t = time.perf_counter()
+            values = src.get(ws_name, [])
+            same = _values_hash(values) == _values_hash(current.get(ws_name, []))
+            if not same:
+                changed[ws_name] = values
+            report[ws_name] = {
+                "status": "変更なし" if same else "更新",
+                "rows": max(len(values) - 1, 0),
+                "hash_ms": round((time.perf_counter() - t) * 1000, 1),
+            }
+
+        write_ms = 0.0
+        if changed:
+            t = time.perf_counter()
+            try:
+                # 読んだ後に画面からマスタへの書き込みが入っていたら、上書きせず次回に回す
+                write_queue.submit("sync", "replace", changed, {n: versions[n] for n in changed})
+            except WriteConflict:
+                return False, "同期中にマスタが更新されたため、同期を次回に持ち越しました。", report
+            write_ms = (time.perf_counter() - t) * 1000
+
+        total_ms = (time.perf_counter() - t_start) * 1000
+        return True, (
+            f"DBシートからマスタを同期しました（更新 {len(changed)} / 変更なし {len(SYNC_TARGETS) - len(changed)}、"
+            f"一括読込 {read_ms:.0f}ms・一括書込 {write_ms:.0f}ms・計 {total_ms:.0f}ms）。"
+        ), report
+
+    except Exception as e:
+        return False, f"DB同期エラー: {e}", report
+
+# --- 同期ワーカー ---
+# secrets.toml の [sync] で設定します（interval = 0 でワーカーを止め、「更新」ボタンでの同期に戻す）
+#   [sync]
+#   interval = 600  # 同期の間隔（秒）
+class SyncWorker:
+    """DBシートからのマスタ同期とマスタのキャッシュ先読みを、バックグラウンドのスレッドで定期実行する
+
+    起動直後に1回、その後は interval 秒ごと（または trigger() されたとき）に動きます。
+    画面側はキャッシュを読むだけなので、同期の終わりを待つことはありません。
+    """
+
+    def __init__(self, interval, db_id):
+        self.interval = interval
+        self.db_id = db_id
+        self.lock = threading.Lock()
+        self._wake = threading.Event()
+        self._status = {"state": "待機中", "at": None, "ms": None, "msg": "", "report": {}}
+        self._thread = threading.Thread(target=self._run, name="master-sync", daemon=True)
+        self._thread.start()
+
+    def trigger(self):
+        self._wake.set()
+
+    def status(self):
+        with self.lock:
+            return dict(self._status)
+
+    def _run(self):
+        while True:
+            self.run_once()
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def run_once(self):
+        with self.lock:
+            self._status["state"] = "実行中"
+        t = time.perf_counter()
+        try:
+            ok, msg, report = sync_from_database_sheet(self.db_id)
+            # 同期の有無にかかわらず、マスタはここで読み込んでおく（利用者の画面で読ませない）
+            for name in MASTER_SHEETS + ["user_master"]:
+                load_data(name)
+            retention_job.run_if_due()
+        except Exception as e:
+            ok, msg, report = False, f"同期ワーカーエラー: {e}", {}
+        with self.lock:
+            self._status = {
+                "state": "完了" if ok else "スキップ/エラー", "at": datetime.now(),
+                "ms": round((time.perf_counter() - t) * 1000), "msg": msg, "report": report,
+            }
+
+@st.cache_resource
+def get_sync_worker():
+    interval = float(dict(st.secrets.get("sync", {})).get("interval", 600))
+    if interval <= 0:
+        return None
+    return SyncWorker(interval, st.secrets.get("db_spreadsheet_id", ""))
+
+sync_worker = get_sync_worker()
+
+# --- 2-1. 認証インデックス ---
+class CredentialIndex:
+    """user_master から作る ID → (パスワードのハッシュ, role, user_info) の索引
+
+    ログインはこの索引を引くだけで、シートは読みません。user_master への行単位の書き込みは
+    write_queue が apply_* でそのまま反映します（索引が書き込み直前のバージョン since と一致するときだけ）。
+    作り直しの途中で書き込みが始まったときは、作った索引を使いません（次のログインで作り直す）。
+    DB同期など索引を通らない書き込みは user_master のキャッシュバージョンの違いで検知します。
+    それ以外で作り直すのはマスタと同じ保持時間（master_ttl）を過ぎたときだけです。
+    """
+
+    # 未登録IDでログインされたときに読み直す最短間隔（秒）
+    RELOAD_INTERVAL = 30
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._salt = os.urandom(16)
+        self._users = {}
+        self.version = None
+        self.loaded_at = 0.0
+
+    def _hash(self, password):
+        return hashlib.sha256(self._salt + str(password).strip().encode("utf-8")).digest()
+
+    def _table(self, users):
+        table = {}
+        if users.empty or not {"id", "password", "role"} <= set(users.columns):
+            return table
+        for row in users.to_dict("records"):
+            user_info = {k: v for k, v in row.items() if k != "password"}
+            user_info["id"] = str(row["id"]).strip()
+            table.setdefault(user_info["id"], []).append({"pw": self._hash(row["password"]), "info": user_info})
+        return table
+
+    def rebuild(self):
+        version = sheet_cache.version("user_master")
+        table = self._table(load_data("user_master"))
+        with self.lock:
+            if version != sheet_cache.version("user_master"):
+                return
+            self._users = table
+            self.version = version
+            self.loaded_at = time.monotonic()
+
+    def authenticate(self, user_id, password):
+        stale = time.monotonic() - self.loaded_at > sheet_cache.master_ttl
+        if stale or self.version != sheet_cache.version("user_master"):
+            self.rebuild()
+        uid = str(user_id).strip()
+        entries = self._users.get(uid)
+        if entries is None and time.monotonic() - self.loaded_at > self.RELOAD_INTERVAL:
+            self.rebuild()
+            entries = self._users.get(uid)
+        digest = self._hash(password)
+        for entry in entries or []:
+            if hmac.compare_digest(entry["pw"], digest):
+                return dict(entry["info"])
+        return None
+
+    def apply_append(self, records, since, version):
+        with self.lock:
+            if self.version != since:
+                return
+            for uid, entries in self._table(pd.DataFrame(records)).items():
+                self._users.setdefault(uid, []).extend(entries)
+            self.version = version
+
+    def apply_update(self, changes, since, version):
+        with self.lock:
+            if self.version != since:
+                return
+            for key, row_changes in changes.items():
+                for entry in self._users.pop(str(key).strip(), []):
+                    user_info = dict(entry["info"])
+                    user_info.update({k: v for k, v in row_changes.items() if k != "password"})
+                    user_info["id"] = str(user_info["id"]).strip()
+                    pw = self._hash(row_changes["password"]) if "password" in row_changes else entry["pw"]
+                    self._users.setdefault(user_info["id"], []).append({"pw": pw, "info": user_info})
+            self.version = version
+
+    def apply_delete(self, keys, since, version):
+        with self.lock:
+            if self.version != since:
+                return
+            for key in keys:
+                self._users.pop(str(key).strip(), None)
+            self.version = version
+
+@st.cache_resource
+def get_credential_index():
+    return CredentialIndex()
+
+cred_index = get_credential_index()
+
+# --- 2-2. 期限データの索引 ---
+class RecordIndex:
+    """expiry_records のキャッシュ中の表を 店舗 → 行位置 で引き、ロール別の一覧を結果件数分の処理で返す
+
+    管轄者は担当店（target_id）、支部は shop_master の所属店の和集合を引きます。
+    表はキャッシュのものをコピーせずに持ち、行位置（groupby の indices）は表が差し替わったとき
+    （書き込みの反映・TTL切れでの読み足し）に1回だけ求め直します。索引は表から作るだけなので、
+    書き込みとの順序を気にする必要はありません。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._frame = None
+        self._positions = {}  # shop_id → 行位置の配列（登録順）
+        self._branch_shops = {}
+        self._shop_version = None
+
+    def _current(self):
+        df = _shared_frame("expiry_records")
+        with self.lock:
+            if df is not self._frame:
+                positions = df.groupby("shop_id", observed=True, sort=False).indices if "shop_id" in df else {}
+                self._frame, self._positions = df, positions
+            return self._frame, self._positions
+
+    def branch_shops(self, branch_id):
+        version = sheet_cache.version("shop_master")
+        if self._shop_version != version or not self._branch_shops:
+            s_master = load_data("shop_master")
+            if not s_master.empty:
+                self._branch_shops = s_master.groupby("branch_id", observed=True)["shop_name"].agg(list).to_dict()
+            self._shop_version = version
+        return self._branch_shops.get(branch_id, [])
+
+    def for_shops(self, shops):
+        df, positions = self._current()
+        parts = [positions[s] for s in dict.fromkeys(shops) if s in positions]
+        rows = np.concatenate(parts) if parts else np.array([], dtype=int)
+        return df.take(rows).reset_index(drop=True)
+
+    def shops_for(self, role, info):
+        """ロールが見られる店舗の一覧（マスターはすべてなので None）"""
+        if role == "店舗":
+            return [info["name"]]
+        if role == "管轄者":
+            return info["target_id"].split(",")
+        if role == "支部":
+            return self.branch_shops(info["id"])
+        return None
+
+    def for_role(self, role, info):
+        shops = self.shops_for(role, info)
+        return load_data("expiry_records") if shops is None else self.for_shops(shops)
+
+@st.cache_resource
+def get_record_index():
+    return RecordIndex()
+
+record_index = get_record_index()
+
+# --- 2-3. 期限の集計 ---
+class ExpiryAnalytics:
+    """expiry_records の期限の近さ別の件数をまとめて集計する
+
+    表はキャッシュのものをコピーせずに使い、集計結果はキャッシュの表が差し替わる
+    （書き込みの反映・TTL切れでの読み足し）か、日付が変わるまで使い回します。
+    """
+
+    # (表示名, 残り日数の下限, 上限)。7/30/60日以内は期限切れを含まない累計
+    BUCKETS = [("期限切れ", None, -1), ("7日以内", 0, 7), ("30日以内", 0, 30), ("60日以内", 0, 60)]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._frame = None
+        self._summaries = {}
+
+    def frame(self):
+        df = _shared_frame("expiry_records")
+        with self.lock:
+            if df is not self._frame:
+                self._frame, self._summaries = df, {}
+            return self._frame
+
+    def summary(self, by, shops=None):
+        """by（shop_id / branch_id / category）ごとの件数表。shops を渡すとその店舗だけを集計"""
+        frame = base = self.frame()
+        key = (by, None if shops is None else tuple(shops), date.today())
+        with self.lock:
+            if key in self._summaries:
+                return self._summaries[key]
+        if frame.empty:
+            return pd.DataFrame(columns=["件数"] + [b[0] for b in self.BUCKETS])
+        if shops is not None:
+            frame = frame[frame["shop_id"].isin(shops)]
+        days = (frame["expiry_date"] - pd.Timestamp(date.today())).dt.days
+        flags = pd.DataFrame({"件数": 1}, index=frame.index)
+        for label, lo, hi in self.BUCKETS:
+            flags[label] = days.le(hi) if lo is None else days.between(lo, hi)
+        result = flags.groupby(frame[by], observed=True).sum().astype(int).sort_values(["期限切れ", "7日以内"], ascending=False)
+        with self.lock:
+            if self._frame is base:  # 集計中に表が差し替わっていたら残さない
+                self._summaries[key] = result
+        return result
+
+@st.cache_resource
+def get_expiry_analytics():
+    return ExpiryAnalytics()
+
+expiry_analytics = get_expiry_analytics()
+
+# --- 2-4. 商品カタログ ---
+class ItemCatalog:
+    """期限入力の画面用に、item_master をカテゴリごとにまとめておく
+
+    まとめ直すのは item_master のキャッシュバージョンが変わったときと、マスタのTTLを過ぎたときだけです。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.loaded_at = 0.0
+        self._items = pd.DataFrame()
+        self._groups = []
+
+    def _refresh(self):
+        version = sheet_cache.version("item_master")
+        stale = time.monotonic() - self.loaded_at > sheet_cache.ttl_for("item_master")
+        if stale or version != self.version:
+            items = load_data("item_master")
+            groups = []
+            if not items.empty:
+                # カテゴリは item_master に出てくる順
+                for cat, part in items.groupby("category", sort=False, observed=True):
+                    groups.append((cat, part.to_dict("records")))
+            with self.lock:
+                self._items, self._groups = items, groups
+                self.version, self.loaded_at = version, time.monotonic()
+
+    def items(self):
+        self._refresh()
+        return self._items
+
+    def groups(self):
+        """[(カテゴリ, [商品のレコード, ...]), ...]"""
+        self._refresh()
+        return self._groups
+
+@st.cache_resource
+def get_item_catalog():
+    return ItemCatalog()
+
+item_catalog = get_item_catalog()